@@ -0,0 +1,60 @@
+""" Compares the vectorized beat warping in util.alignment against the old per-note beat scan from process_midi. """
+
+import argparse
+import timeit
+
+import numpy as np
+
+from util.alignment import warp_onsets
+
+
+def warp_onsets_loop(onsets, perf_beats, score_beats): # the old linear scan, kept here as the reference
+    new_offsets = []
+    for offset in onsets:
+        for i, b_off in enumerate(perf_beats):
+            if b_off > offset:
+                a = 0 if i == 0 else perf_beats[i-1]
+                b = b_off
+                beat_index = i
+                break
+        else:
+            a = perf_beats[-1]
+            b = perf_beats[-1] + (perf_beats[-1]-perf_beats[-2])
+            beat_index = len(perf_beats)
+            if offset > b:
+                b = offset + .01
+
+        a_prime = 0 if beat_index == 0 else score_beats[beat_index-1]
+        b_prime = score_beats[beat_index-1] + (score_beats[beat_index-1] - score_beats[beat_index-2]) if beat_index == len(perf_beats) else score_beats[beat_index]
+
+        new_offsets.append((b_prime - a_prime) / (b - a) * (offset - a) + a_prime)
+    return new_offsets
+
+
+def fake_piece(num_beats, num_notes, seed=0): # roughly the size and shape of a long ASAP performance
+    rng = np.random.default_rng(seed)
+    score_beats = np.cumsum(rng.uniform(.3, .7, num_beats))
+    perf_beats = np.cumsum(rng.uniform(.2, 1., num_beats))
+    onsets = np.sort(rng.uniform(0, perf_beats[-1] + 3, num_notes)) # some notes land past the last beat
+    return onsets.tolist(), perf_beats.tolist(), score_beats.tolist()
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("-b", "--beats", help="Number of beats in the fake piece.", type=int, default=2000)
+argParser.add_argument("-n", "--notes", help="Number of notes in the fake piece.", type=int, default=8000)
+argParser.add_argument("-r", "--repeats", help="Number of timed runs of each version.", type=int, default=3)
+args = argParser.parse_args()
+
+onsets, perf_beats, score_beats = fake_piece(args.beats, args.notes)
+
+expected = warp_onsets_loop(onsets, perf_beats, score_beats)
+got = warp_onsets(onsets, perf_beats, score_beats).tolist()
+assert got == expected, "vectorized warp doesn't match the loop!"
+
+loop_time = min(timeit.repeat(lambda: warp_onsets_loop(onsets, perf_beats, score_beats), number=1, repeat=args.repeats))
+vec_time = min(timeit.repeat(lambda: warp_onsets(onsets, perf_beats, score_beats), number=1, repeat=args.repeats))
+
+print(f"{args.notes} notes, {args.beats} beats")
+print(f"loop:       {loop_time*1000:.2f} ms")
+print(f"vectorized: {vec_time*1000:.2f} ms")
+print(f"speedup:    {loop_time/vec_time:.1f}x")
@@ -0,0 +1,120 @@
+""" Compares the vectorized window features in util.window_features against the old per-note loops from extract_features. """
+
+import argparse
+import timeit
+
+import numpy as np
+
+from util.window_features import window_features
+from util.note_table import read_note_table
+
+
+def window_features_loop(notes, starts, lengths): # the old loops, kept here as the reference
+    new_starts = []
+    new_ends = []
+    down_while = []
+    within = []
+    ahead_only = []
+    behind_only = []
+    exact = []
+    exact_l = []
+    exact_h = []
+    motion = []
+    length_ratio = []
+    time_from_last = []
+    time_to_next = []
+
+    for s, length in zip(starts, lengths):
+        new_starts.append(s)
+        new_ends.append(s + length)
+
+    for n in range(len(new_starts)):
+        down_while.append(0)
+        ahead_only.append([0]*7)
+        behind_only.append([0]*7)
+        exact.append(0)
+        exact_l.append(0)
+        exact_h.append(0)
+        motion.append(0)
+        length_ratio.append(1)
+        time_from_last.append(0)
+        time_to_next.append(0)
+
+        for pos, j in enumerate(new_starts[max(n-100, 0):n]):
+            if j < new_starts[n]:
+                time_from_last[-1] = new_starts[n] - j
+                length_ratio[-1] = lengths[n]/lengths[pos]
+                motion[-1] = notes[n] - notes[pos]
+            if new_starts[n] < j < new_ends[n]:
+                down_while[-1] += 1
+            if new_starts[n] == j:
+                exact[-1] += 1
+                exact_l[-1] += 1
+                continue
+            for t, threshold in enumerate([.01, .05, .1, .5, 1, 2, 4]):
+                if abs(new_starts[n] - j) < threshold:
+                    behind_only[-1][t] += 1
+
+        for j in new_starts[n + 100 : n : -1]:
+            if new_starts[n] < j:
+                time_to_next[-1] = j - new_starts[n]
+            if new_starts[n] < j < new_ends[n]:
+                down_while[-1] += 1
+            if new_starts[n] == j:
+                exact[-1] += 1
+                exact_h[-1] += 1
+                continue
+            for t, threshold in enumerate([.01, .05, .1, .5, 1, 2, 4]):
+                if abs(new_starts[n] - j) < threshold:
+                    ahead_only[-1][t] += 1
+
+        within.append([ahead_only[-1][i]+behind_only[-1][i] for i in range(7)])
+
+    return {
+        "down_while": down_while,
+        "exact": exact,
+        "exact_l": exact_l,
+        "exact_h": exact_h,
+        "motion": motion,
+        "length_ratio": length_ratio,
+        "time_from_last": time_from_last,
+        "time_to_next": time_to_next,
+        "within": np.transpose(within).tolist(),
+        "behind_only": np.transpose(behind_only).tolist(),
+        "ahead_only": np.transpose(ahead_only).tolist(),
+    }
+
+
+def fake_piece(num_notes, seed=0): # chords and runs on a sixteenth note grid, like the processed score times
+    rng = np.random.default_rng(seed)
+    starts = np.sort(rng.integers(0, num_notes // 2, num_notes)) * .125
+    lengths = rng.choice([.125, .25, .5, 1.], num_notes)
+    notes = rng.integers(40, 90, num_notes)
+    return notes.astype(float).tolist(), starts.tolist(), lengths.tolist()
+
+
+argParser = argparse.ArgumentParser()
+argParser.add_argument("tables", nargs="*", help="Processed note tables (.npz) to time, instead of fake pieces.", type=str)
+argParser.add_argument("-n", "--notes", help="Sizes of the fake pieces.", type=int, nargs="+", default=[500, 2000, 8000])
+argParser.add_argument("-r", "--repeats", help="Number of timed runs of the vectorized version.", type=int, default=5)
+args = argParser.parse_args()
+
+if args.tables:
+    pieces = {}
+    for path in args.tables:
+        table = read_note_table(path)
+        pieces[path] = [table[column].astype(float).tolist() for column in ["note", "time", "len_m"]]
+else:
+    pieces = {f"fake {num_notes}": fake_piece(num_notes) for num_notes in args.notes}
+
+for name, (notes, starts, lengths) in pieces.items():
+    start = timeit.default_timer()
+    expected = window_features_loop(notes, starts, lengths)
+    loop_time = timeit.default_timer() - start
+
+    got = window_features(notes, starts, lengths)
+    for key in expected:
+        assert np.array_equal(np.asarray(got[key]), np.asarray(expected[key])), f"{key} doesn't match the loop for {name}!"
+
+    vec_time = min(timeit.repeat(lambda: window_features(notes, starts, lengths), number=1, repeat=args.repeats))
+    print(f"{name}: {len(starts)} notes, loop {loop_time*1000:.1f} ms, vectorized {vec_time*1000:.2f} ms, {loop_time/vec_time:.0f}x")
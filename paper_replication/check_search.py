@@ -0,0 +1,116 @@
+""" Checks util.search without the data or the lab machines: a fake scorer stands in for score_trial, and CommandWorker runs
+the --worker protocol locally the way SSHWorker runs it remotely. Checks that every trial runs exactly once with a result file,
+also when workers are lost partway or stop answering past the trial_timeout (their trials have to go back in the queue), and
+that a trial that takes down every worker it goes to only takes down TRIAL_LOSSES of them before it counts as failed. """
+
+import os
+import json
+import signal
+import glob
+import time
+import argparse
+import tempfile
+
+from util.search import TRIAL_LOSSES, WorkerLost, CommandWorker, search, trial_setup, sample_trials
+
+
+def fake_score(config, params): # a quick stand-in for score_trial, lowest at lr = .5
+    time.sleep(config.get("fake_seconds", 0))
+    return {"loss": (params["lr"] - .5) ** 2 + params["sr"], "r2": 1 - params["sr"]}
+
+
+def dying_score(config, params): # the worker process dies on the first trial it gets, with the trial unanswered
+    os._exit(1)
+
+
+def hanging_score(config, params): # the worker process stops answering on the first trial it gets, far past the trial_timeout
+    time.sleep(10 * config["trial_timeout"])
+
+
+def poisoned_score(config, params): # fake_score, but the worker process dies on config's poisoned trial, whichever worker runs it
+    if params == sample_trials(config)[config["poisoned"]]:
+        os._exit(1)
+    return fake_score(config, params)
+
+
+class FakeWorker:
+    # a worker in this process scoring with fake_score. with lost_after, it's lost (raises WorkerLost) after that many trials
+    def __init__(self, config, name, lost_after=None):
+        self.config = config
+        self.name = name
+        self.lost_after = lost_after
+        self.done = 0
+        self.lost = False
+
+    def start(self):
+        pass
+
+    def run(self, params):
+        if self.done == self.lost_after:
+            self.lost = True
+            raise WorkerLost(f"{self.name} lost")
+        self.done += 1
+        returned = fake_score(self.config, params)
+        returned.update(status="ok", start_time=time.time(), duration=0.)
+        return returned
+
+    def close(self):
+        pass
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("-n", "--trials", help="Number of trials in the search.", type=int, default=40)
+    argParser.add_argument("-s", "--stand-ins", help="Number of CommandWorker stand-ins.", type=int, default=2)
+    args = argParser.parse_args()
+
+    with tempfile.TemporaryDirectory() as exp:
+        config = {
+            "exp": exp,
+            "hp_max_evals": args.trials,
+            "seed": 42,
+            "fake_seconds": .01,
+            "trial_timeout": 5,
+            "hp_space": {"lr": ["loguniform", 1e-1, 1], "sr": ["uniform", 0, .1], "N": ["choice", 1000]},
+        }
+
+        workers = [FakeWorker(config, "fake"), FakeWorker(config, "fake lost", lost_after=1)]
+        workers += [CommandWorker(trial_setup(config, scorer="check_search.fake_score"), name=f"stand-in {i}") for i in range(args.stand_ins)]
+        dying = CommandWorker(trial_setup(config, scorer="check_search.dying_score"), name="dying stand-in")
+        hanging = CommandWorker(trial_setup(config, scorer="check_search.hanging_score"), name="hanging stand-in")
+        workers += [dying, hanging]
+
+        done = []
+        best_params, best = search(config, workers, progress=lambda n, total: done.append(n))
+
+        results = [json.load(open(path)) for path in glob.glob(os.path.join(exp, "results", "*_hyperopt_results_*call.json"))]
+        ran = sorted(json.dumps(result["current_params"], sort_keys=True) for result in results)
+        expected = sorted(json.dumps(params, sort_keys=True) for params in sample_trials(config))
+
+        assert workers[1].lost and dying.process.returncode == 1 and hanging.process.returncode == -signal.SIGKILL, "the workers that should have been lost weren't"
+        assert done[-1] == args.trials, f"only {done[-1]} of {args.trials} trials finished"
+        assert ran == expected, "the result files aren't exactly one per trial"
+        assert best["loss"] == min(result["returned_dict"]["loss"] for result in results), "search didn't return the best trial"
+        assert all(result["returned_dict"]["status"] == "ok" for result in results)
+
+    print(f"{args.trials} trials on {len(workers)} workers, three of them lost partway")
+    print("all trials ran once, with a result file each")
+    print(f"best: {best_params} loss {best['loss']:.5f}")
+
+    with tempfile.TemporaryDirectory() as exp:
+        config.update(exp=exp, poisoned=args.trials // 2)
+        workers = [CommandWorker(trial_setup(config, scorer="check_search.poisoned_score"), name=f"stand-in {i}") for i in range(TRIAL_LOSSES + 1)]
+
+        done = []
+        search(config, workers, progress=lambda n, total: done.append(n))
+
+        results = [json.load(open(path)) for path in glob.glob(os.path.join(exp, "results", "*_hyperopt_results_*call.json"))]
+        ran = sorted(json.dumps(result["current_params"], sort_keys=True) for result in results)
+        trials = sample_trials(config)
+        expected = sorted(json.dumps(params, sort_keys=True) for params in trials[:config["poisoned"]] + trials[config["poisoned"] + 1:])
+
+        assert sum(worker.process.returncode == 1 for worker in workers) == TRIAL_LOSSES, f"the poisoned trial didn't take down exactly {TRIAL_LOSSES} workers"
+        assert done[-1] == args.trials, f"only {done[-1]} of {args.trials} trials finished"
+        assert ran == expected, "the result files aren't exactly one per trial but the poisoned one"
+
+    print(f"a trial that kills its worker took down {TRIAL_LOSSES} of {len(workers)} and counted as failed, the rest all ran")
@@ -14,7 +14,7 @@ import numpy as np
 from util.load_data import prepare_dataset
 from util.generate_midi import apply_outputs
 
-data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece.json"
+data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece"
 metadata_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-master/metadata.csv"
 
 ASAP_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-master"
@@ -112,6 +112,6 @@ for piece in test_data_vel.keys():
 
     print(len(outputs_vel), len(outputs_len))
 
-    perf_path = os.path.join(PROCESSED_PATH, piece)[:-4] + ".txt"
+    perf_path = os.path.join(PROCESSED_PATH, piece)[:-4] + ".npz"
     
     apply_outputs(perf_path, f"/stash/tlab/theom_intern/midi_data/{model_name}2human/{piece.replace('/','')}.mid", outputs_vel, outputs_len)
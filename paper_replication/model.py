@@ -9,7 +9,7 @@ import numpy as np
 
 from util.load_data import prepare_dataset
 
-data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece.json"
+data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece"
 metadata_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-master/metadata.csv"
 
 
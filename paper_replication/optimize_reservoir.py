@@ -2,8 +2,6 @@ import sys
 import os
 import argparse
 import json
-import random
-from functools import wraps
 
 #import tensorflow
 #from tensorflow import keras
@@ -11,15 +9,17 @@ from functools import wraps
 import pickle
 import numpy as np
 
-from reservoirpy.observables import mse, rsquare
 from reservoirpy.nodes import Reservoir, Ridge # type: ignore
 from reservoirpy.hyper import plot_hyperopt_report # type: ignore
 from reservoirpy.hyper import research # type: ignore
-from util.load_data import prepare_dataset
+from util.load_data import prepare_arrays, prepare_dataset
 from util.reservoir_model import create_model, load_model, store_model
+from util.evaluation import evaluate, score_pieces
+from util.state_cache import RidgeSolver, dataset_fingerprint, readout_accumulators
+from util.trials import FAILED_TRIAL, INSTANCE_ERRORS, run_instances, summarize_sweeps, training_pieces, trial_ridges
 
 
-data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece.json"
+data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece"
 metadata_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-master/metadata.csv"
 
 argParser = argparse.ArgumentParser()
@@ -54,32 +54,30 @@ if goal == "Micro":
         ["Len_M", "Melodic_Charge", "W.50", "B.10", "B.50", "A.10", "A.50", "W.50"],
         ["Micro"]
     )"""
-    trd, trt, vad, vat, ted, tet = prepare_dataset(
+    train, val, test = prepare_arrays(
         data_path, metadata_path,
         ["Note", "Exact_L", "Len/BPM"],
         ["Len_M", "Melodic_Charge", "Micro"],
         ["Micro"],
-        train_by_piece=True,
-        sample_repeats=5
+        sample_repeats=5,
+        dtype=np.float64,
+        splits=("train", "val")
     )
 elif goal == "Len_P":
-    trd, trt, vad, vat, ted, tet = prepare_dataset(
+    train, val, test = prepare_arrays(
         data_path, metadata_path,
         ["Len_M", "D_A", "Len/BPM", "Len_Ratio"],
         ["Exact", "Len_P", "Micro", "B.50", "B2.0", "A.50", "A2.0", "W.50", "W2.0"],
-        ["Len_P"]
+        ["Len_P"],
+        dtype=np.float64,
+        splits=("train", "val")
     )
 
-def clean_nans(data, data_is_dict):
-    if data_is_dict:
-        for key in data:
-            is_nan = data[key].isnull().values.any()
-            if not is_nan:
-                continue
-            else:
-                data[key].pop()
-    else:
-        data.dropna()
+def check_nans(split): # a piece with missing values can't be used, there's no dropping a note from the middle of a performance
+    for name in split.pieces:
+        features, targets = split.piece(name)
+        if np.isnan(features).any() or np.isnan(targets).any():
+            raise ValueError(f"Missing values in {name}")
 
 
 '''
@@ -101,181 +99,117 @@ for key in trt:
 '''
 
 
-test_data_vel, test_goals_vel = prepare_dataset(
+# the splits are kept at 1x, sample_repeats is only applied a piece at a time as the pieces are looked up (see util.load_data)
+_, _, test = prepare_arrays(
     data_path, metadata_path,
     ["Note", "Exact_L", "Len/BPM"],
     ["Len_M", "Melodic_Charge", "Micro"],
     ["Micro"],
-    test_data_only=True,
-    sample_repeats=5
+    sample_repeats=5,
+    dtype=np.float64,
+    splits=("test",)
 )
+for split in (train, val, test):
+    check_nans(split)
 
+trd, trt = training_pieces(train) # shuffled like util.trials.load_trial_data
+vad, vat = val.repeated()
+test_data_vel, test_goals_vel = test.repeated_by_piece()
 
-def _elementwise(func):
-    """Vectorize a function to apply it
-    on arrays.
-    """
-    vect = np.vectorize(func)
-
-    @wraps(func)
-    def vect_wrapper(*args, **kwargs):
-        u = np.asanyarray(args)
-        v = vect(u)
-        return v[0]
-
-    return vect_wrapper
-
-
-@_elementwise
-def softplus(x: np.ndarray) -> np.ndarray:
-    return np.log(1 + np.exp(-np.abs(x))) + np.maximum(x,0)
 
-@_elementwise
-def hard_sigmoid(x: np.ndarray) -> np.ndarray:
-    if x <= -3:
-        return 0
-    if x >= 3:
-        return 1
-    return ((x/6) + .5)
-
-@_elementwise
-def relu_test(x: np.ndarray) -> np.ndarray:
-
-    if x < 0:
-        return 0.0
-    return x
-
-def objective(dataset, config, *, N, sr, lr, input_scaling, ridge, seed, rc_connectivity, input_connectivity):
+def objective(dataset, config, *, N, sr, lr, input_scaling, seed, rc_connectivity, input_connectivity, ridge=None, activation="relu"):
+    # without a ridge, every trial scores the readout for each of config["ridges"] (RIDGES if not set) and keeps the best one
     global current_run
     
-    trd, trt, vad, vat = dataset
-
-    clean_nans(trd, True)
-    clean_nans(trt, True)
-    
-    clean_nans(vad, False)
-    clean_nans(vat, False)
-
-    clean_nans(test_data_vel, True)
-    clean_nans(test_goals_vel, True)
-
-    trd_keys = list(trd.keys())
-    random.Random(4).shuffle(trd_keys)
-    trd = [trd[k] for k in trd_keys]
-    trt = [trt[k] for k in trd_keys]
+    trd, trt, vad, vat = dataset # the training pieces already shuffled, see training_pieces
 
-    trd, trt, = map(lambda abc: [np.squeeze(one_piece.to_numpy()) for one_piece in abc], [trd, trt])
+    first = next(iter(trd))
+    print(trd[first].shape, trt[first].shape, vad.shape, vat.shape)
 
-    trt = [i.reshape(-1, 1) for i in trt]
-
-    print(trd[0].shape, trt[0].shape, vad.shape, vat.shape)
+    fingerprint = dataset_fingerprint(trd.values(), trt.values())
 
     instances = config['instances_per_trial']
 
     # the seed should change between each trial to prevent bias
     trial_seed = seed
 
-    losses = []
-    r2s = []
-    for i in range(instances):
-        try:
-            model = create_model(input_scaling, N, sr, lr, ridge, trial_seed, rc_connectivity, input_connectivity, relu_test)
-
-            model.fit(trd, trt)
-
-            pieces = list(test_data_vel.keys())
-            print(len(pieces))
-
-            loss = 0
-            r2 = 0
-
-            for i, piece in enumerate(pieces):
+    ridges = trial_ridges(config, ridge)
 
-                piece_data_vel = test_data_vel[piece]
+    # the reservoir only runs over the training pieces the first time these parameters come up, see util.state_cache
+    instance_params = [dict(input_scaling=input_scaling, N=N, sr=sr, lr=lr, seed=trial_seed + i, rc_connectivity=rc_connectivity, input_connectivity=input_connectivity, activation_func=activation)
+                       for i in range(instances)]
 
-                vad = np.squeeze(piece_data_vel.to_numpy())
-                #vad = piece_data_vel
-                piece_len = vad.shape[0]
-
-                predictions = model.run(vad, reset=True)
-
-
-                """
-                predictions = []
-
-                for row in range(len(vad)):
-                    if goal == "Micro" and row > 0:
-                        vad.loc[row, "-1_Micro"] = float(out) 
-                    inputs = vad.loc[row]
-                    #if row < 3:
-                    #    print(inputs)
-
-                    inputs = np.squeeze(inputs.to_numpy())
-                    #if row < 3:
-                    #    print(inputs)
+    pieces = list(test_data_vel.keys())
+    print(len(pieces))
 
-                    out = model(inputs)[0]
-                    predictions.append(out)
+    # the instances run side by side in worker processes, see util.trials. each runs its reservoir over the test pieces once, and
+    # the readout for each ridge value is scored on those states
+    futures = run_instances(
+        instance_params,
+        trd, trt,
+        test_data_vel, test_goals_vel,
+        ridges, fingerprint,
+        workers=config.get("instance_workers", min(instances, os.cpu_count()))
+    )
 
-                    #de = f"{ted.iloc[row]['Len_M']}"
-                    #print(out)
-                """
+    sweeps = [] # per instance, the loss and r2 for each of ridges
+    for reservoir_params, future in zip(instance_params, futures):
+        trial_seed = reservoir_params["seed"]
+        try:
+            sweep, instance_ridge, predictions, accumulators = future.result()
+            print(sweep[["ridge", "loss", "r2"]].to_string(index=False))
 
-                a, b = [predictions[j][0] for j in range(len(predictions))], [test_goals_vel[piece].iloc[j]["Micro"] for j in range(len(predictions))]
-                
-                if i == 8:
-                    for j in range(len(predictions)):
-                        print(f"{a[j]}\t{b[j]}")
-                
-                loss += mse(a, b)
-                r2 += rsquare(b, a)
+            results, pooled = score_pieces(predictions, test_goals_vel)
 
-                print(f"Piece {i}: {mse(a, b)}")
+            if len(pieces) > 8:
+                for a, b in zip(predictions[pieces[8]][:, 0], test_goals_vel[pieces[8]][:, 0]):
+                    print(f"{a}\t{b}")
 
-                #print(f"Piece {i}: {loss}")
-            
-            loss /= len(pieces)
-            r2 /= len(pieces)
+            for i, piece_mse in enumerate(results["mse"]):
+                print(f"Piece {i}: {piece_mse}")
 
-            print(f"All pieces: {loss}")
+            print(f"All pieces: {results['mse'].mean()} (ridge {instance_ridge})")
 
-            losses.append(loss)
-            r2s.append(r2)
-        except ValueError:
-            losses.append(10000)
-            r2s.append(0)
+            sweeps.append(sweep[["loss", "r2"]].to_numpy())
+        except INSTANCE_ERRORS:
+            accumulators = None
+            sweeps.append(np.tile(FAILED_TRIAL, (len(ridges), 1)))
             error_hps = {
                 "current_run_num": current_run,
                 "input_scaling": input_scaling,
                 "neuron_num": N,
                 "spectral_radius": sr,
                 "leak_rate": lr,
-                "ridge": ridge,
+                "ridges": ridges.tolist(),
                 "trial_seed": trial_seed,
                 "rc_connectivity": rc_connectivity,
-                "input_connectivity": input_connectivity
+                "input_connectivity": input_connectivity,
+                "activation": activation
             }
             with open(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/{cpu_name}_hp_search/errors.json", "a") as f:
                 json.dump(error_hps, f)
                 f.write('\n')
 
-        trial_seed += 1
-
         if args.tune:
             current_run += 1
 
             with open(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/{cpu_name}_hp_search/completion.txt", "w+") as f:
                 f.write(f"{current_run}")
 
+    returned = summarize_sweeps(ridges, sweeps) # the ridge with the lowest loss over all the instances
+    best_ridge = returned['ridge']
+
     if args.tune:
         with open(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/{cpu_name}_hp_search/{cpu_name}_all_hps.txt", "a") as f:
-            f.write(f"\n{N}\t{sr}\t{lr}\t{ridge}\t{input_scaling}\t{np.mean(losses)}")
+            f.write(f"\n{N}\t{sr}\t{lr}\t{best_ridge}\t{input_scaling}\t{returned['loss']}")
     else:
         print("Saving model...")
+        # the last instance sends back its accumulators, the readout_accumulators call only harvests again if it failed
+        solver = RidgeSolver(*(accumulators or readout_accumulators(instance_params[-1], trd.values(), trt.values(), fingerprint)))
+        model = create_model(input_scaling, N, sr, lr, best_ridge, trial_seed, rc_connectivity, input_connectivity, activation, readout=solver.readout(best_ridge))
         pickle.dump(model, open(f"/stash/tlab/theom_intern/res_models/{save_name}.p", "wb" ) )
     
-    return {'loss': np.mean(losses),
-            'r2': np.mean(r2s)}
+    return returned
 
 
 if args.tune:
@@ -287,7 +221,7 @@ if args.tune:
     best = research(objective, [trd, trt, vad, vat], f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/{cpu_name}_hp_search/{cpu_name}.config.json")
     with open(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/{cpu_name}_hp_search/{cpu_name}_best_hps.txt", "a") as f:
         f.write(str(best))
-    fig = plot_hyperopt_report(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}", ("lr", "sr", "ridge", "rc_connectivity", "input_connectivity"), metric="r2")
+    fig = plot_hyperopt_report(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}", ("lr", "sr", "rc_connectivity", "input_connectivity"), metric="r2")
     fig.savefig(f"/stash/tlab/theom_intern/distributed_reservoir_runs/{save_name}/figure1.png")
     fig.show()
 elif not args.no_train:
@@ -327,33 +261,12 @@ elif not args.no_train:
     pieces = list(test_data_vel.keys())
     print(len(pieces))
 
-    total_mse = 0
-    no_model_mse = 0
-    total_mse_len = 0
-
-    for i, piece in enumerate(pieces):
-
-
-        piece_data_vel = test_data_vel[piece]
-
-        vad = np.squeeze(piece_data_vel.to_numpy())
-        piece_len = vad.shape[0]
-
-        predictions = model.run(vad, reset=True)
-
-
-        piece_mse = 0
+    results, pooled, predictions = evaluate(model, {piece: np.squeeze(test_data_vel[piece].to_numpy()) for piece in pieces}, test_goals_vel)
 
-        for j in range(len(predictions)):
-            piece_mse += (predictions[i][0] - test_goals_vel[piece].iloc[i]["Micro"])**2
-            no_model_mse += (test_goals_vel[piece].iloc[i]["Micro"])**2
-            #print(f'{predictions[i][0]}\t{test_goals_vel[piece].iloc[i]["Micro"]}')
-        total_mse += piece_mse
-        total_mse_len += piece_len
-        piece_mse /= piece_len
+    for i, piece_mse in enumerate(results["mse"]):
         print(f"Piece {i}: {piece_mse}")
-    print(f"All pieces: {total_mse / total_mse_len}")
-    print(f"No model: {no_model_mse / total_mse_len}")
+    print(f"All pieces: {pooled['mse']}")
+    print(f"No model: {pooled['zero_mse']}")
 
     # storeModel(model)
 
@@ -10,8 +10,9 @@ import numpy as np
 from reservoirpy.nodes import Reservoir, Ridge, FORCE
 
 from util.load_data import prepare_dataset
+from util.evaluation import evaluate
 
-data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece.json"
+data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece"
 metadata_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-master/metadata.csv"
 
 
@@ -166,35 +167,16 @@ else:
         pieces = list(test_data_vel.keys())
         print(len(pieces))
 
-        total_mse = 0
-        no_model_mse = 0
-        total_mse_len = 0
+        results, pooled, predictions = evaluate(model, {piece: np.squeeze(test_data_vel[piece].to_numpy()) for piece in pieces}, test_goals_vel)
 
-        for i, piece in enumerate(pieces):
+        if len(pieces) > 8:
+            for a, b in zip(predictions[pieces[8]][:, 0], test_goals_vel[pieces[8]]["Micro"]):
+                print(f"{a}\t{b}")
 
-
-            piece_data_vel = test_data_vel[piece]
-
-            vad = np.squeeze(piece_data_vel.to_numpy())
-            piece_len = vad.shape[0]
-
-            predictions = model.run(vad, reset=True)
-
-
-            piece_mse = 0
-
-            for j in range(len(predictions)):
-                if i == 8:
-                    print(f"{predictions[j][0]}\t{test_goals_vel[piece].iloc[j]['Micro']}")
-                piece_mse += (predictions[j][0] - test_goals_vel[piece].iloc[j]["Micro"])**2
-                no_model_mse += (test_goals_vel[piece].iloc[j]["Micro"])**2
-                #print(f'{predictions[i][0]}\t{test_goals_vel[piece].iloc[i]["Micro"]}')
-            total_mse += piece_mse
-            total_mse_len += piece_len
-            piece_mse /= piece_len
+        for i, piece_mse in enumerate(results["mse"]):
             print(f"Piece {i}: {piece_mse}")
-        print(f"All pieces: {total_mse / total_mse_len}")
-        print(f"No model: {no_model_mse / total_mse_len}")
+        print(f"All pieces: {pooled['mse']}")
+        print(f"No model: {pooled['zero_mse']}")
 
         storeModel(model)
 
@@ -211,35 +193,12 @@ else:
         pieces = list(test_data_vel.keys())
         print(len(pieces))
 
-        total_mse = 0
-        no_model_mse = 0
-        total_mse_len = 0
-
-        for i, piece in enumerate(pieces):
-            
-            piece_data_vel = test_data_vel[piece]
-
-            vad = np.squeeze(piece_data_vel.to_numpy())
-            piece_len = vad.shape[0]
-
-            # PRINT PREDICTED, EXPECTED
-            predictions = model.run(vad, reset=True)
-            #for j in range(len(predictions)):
-            #    print(f"{predictions[j][0]}\t{test_goals_vel[piece].iloc[j]['Micro']}")
-
-
-            piece_mse = 0
+        results, pooled, predictions = evaluate(model, {piece: np.squeeze(test_data_vel[piece].to_numpy()) for piece in pieces}, test_goals_vel)
 
-            for j in range(len(predictions)):
-                piece_mse += (predictions[j][0] - test_goals_vel[piece].iloc[j]["Micro"])**2
-                no_model_mse += (test_goals_vel[piece].iloc[j]["Micro"])**2
-                #print(f'{predictions[i][0]}\t{test_goals_vel[piece].iloc[i]["Micro"]}')
-            total_mse += piece_mse
-            total_mse_len += piece_len
-            piece_mse /= piece_len
+        for i, piece_mse in enumerate(results["mse"]):
             print(f"Piece {i}: {piece_mse}")
-        print(f"All pieces: {total_mse / total_mse_len}")
-        print(f"No model: {no_model_mse / total_mse_len}")
+        print(f"All pieces: {pooled['mse']}")
+        print(f"No model: {pooled['zero_mse']}")
 
 
     model = keras.models.load_model(f"/stash/tlab/theom_intern/models/{save_name}/{goal}")
@@ -1,18 +1,17 @@
 import argparse
 import json
 import random
-from functools import wraps
 
 import pandas
 import matplotlib.pyplot as plt
 import pickle
 import numpy as np
 
-from reservoirpy.observables import mse, rsquare
+from util.load_data import prepare_arrays, repeat_rows, collapse_repeats
+from util.activations import relu
+from util.evaluation import evaluate
 
-from util.load_data import prepare_dataset
-
-data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece.json"
+data_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed/shifted_by_piece"
 metadata_path = "/stash/tlab/theom_intern/midi_data/asap-dataset-master/metadata.csv"
 
 argParser = argparse.ArgumentParser()
@@ -27,92 +26,44 @@ model_name = args.model
 goal = args.goal
 
 
-def _elementwise(func):
-    """Vectorize a function to apply it
-    on arrays.
-    """
-    vect = np.vectorize(func)
-
-    @wraps(func)
-    def vect_wrapper(*args, **kwargs):
-        u = np.asanyarray(args)
-        v = vect(u)
-        return v[0]
-
-    return vect_wrapper
-
-@_elementwise
-def relu_test(x: np.ndarray) -> np.ndarray:
+relu_test = relu # models stored before util.activations pickled their activation as __main__.relu_test
 
-    if x < 0:
-        return 0.0
-    return x
 
-
-trd, trt, vad, vat, ted, tet = prepare_dataset(
+# the model sees each note sample_repeats times, its predictions are averaged back down before scoring
+sample_repeats = 5
+train, val, test = prepare_arrays(
     data_path, metadata_path,
     ["Note", "Exact_L", "Len/BPM"],
     ["Len_M", "Melodic_Charge", "Micro"],
     ["Micro"],
-    train_by_piece=True,
-    val_by_piece=True,
-    sample_repeats=5
+    sample_repeats=sample_repeats,
+    dtype=np.float64
 )
 
-trd_no_repeat, trt_no_repeat, vad_no_repeat, vat_no_repeat, ted_no_repeat, tet_no_repeat = prepare_dataset(
-    data_path, metadata_path,
-    ["Note", "Exact_L", "Len/BPM"],
-    ["Len_M", "Melodic_Charge", "Micro"],
-    ["Micro"],
-    train_by_piece=True,
-    val_by_piece=True
-)
 
+print(len(val.pieces))
 
-print(len(vad.keys()))
-
-total_notes = 0
-for key in vad.keys():
-    total_notes += vad[key].shape[0]
+total_notes = len(val.features) * sample_repeats
 print(total_notes)
 
 
 
-loss = 0
-r2 = 0
-for piece in vad.keys():
-    print(piece)
-
-    piece_data_vel = vad[piece]
-    
-    piece_data_vel = np.squeeze(piece_data_vel.to_numpy())
-    
-    model_res = pickle.load( open( f"/stash/tlab/theom_intern/res_models/{model_name}.p", "rb" ) )
-    
-    vel_predictions = model_res.run(piece_data_vel, reset=True)
-    
-    a = []
-    for j in range(0, len(vel_predictions), 5):
-        average = vel_predictions[j:j+5]
-        average_striped = []
-        for i in average:
-            average_striped.append(i[0])
-        average = sum(average_striped)/5
-        a.append(average)
-
+model_res = pickle.load( open( f"/stash/tlab/theom_intern/res_models/{model_name}.p", "rb" ) )
 
-    b = [vat_no_repeat[piece].iloc[j]["Micro"] for j in range(len(a))]
+# every piece through the model at once, see util.evaluation
+pieces_vel, goals_vel = val.by_piece()
+results, pooled, vel_predictions = evaluate(model_res, {piece: repeat_rows(piece_data_vel, sample_repeats) for piece, piece_data_vel in pieces_vel.items()}, goals_vel, repeats=sample_repeats)
 
-    loss += mse(a, b)
-    r2 += rsquare(b, a)
+first_piece = val.pieces[0]
+for a, b in zip(collapse_repeats(vel_predictions[first_piece][:, 0], sample_repeats), goals_vel[first_piece][:, 0]):
+    print(f'{a} {b}')
+print(first_piece)
 
-    if piece == list(vad.keys())[0]:
-        for i in range(len(a)):
-            print(f'{a[i]} {b[i]}')
-        print(piece)
+print(results.to_string())
 
-loss /= len(vad.keys())
-r2 /= len(vad.keys())
+loss = results["mse"].mean()
+r2 = results["r2"].mean()
 
 print('loss', loss)
 print('r2', r2)
+print('pooled', pooled)
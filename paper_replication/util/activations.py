@@ -0,0 +1,48 @@
+""" Reservoir activation functions, vectorized over whole arrays and picklable (so models using them can be stored).
+
+create_model takes any of the names in ACTIVATIONS, which can also go in the hyperopt space as "activation". """
+
+import numpy as np
+
+
+def relu(x):
+    return np.maximum(x, 0.)
+
+
+def hard_sigmoid(x): # 0 up to -3, 1 from 3, linear in between
+    return np.clip(np.asarray(x) / 6 + .5, 0., 1.)
+
+
+def softplus(x): # log(1 + e^x), written so it doesn't overflow for large x
+    return np.log1p(np.exp(-np.abs(x))) + np.maximum(x, 0.)
+
+
+def sigmoid(x):
+    return .5 * (1 + np.tanh(np.asarray(x) / 2)) # same as 1 / (1 + e^-x), without overflowing
+
+
+def tanh(x):
+    return np.tanh(x)
+
+
+def identity(x):
+    return np.asarray(x)
+
+
+ACTIVATIONS = {
+    "relu": relu,
+    "hard_sigmoid": hard_sigmoid,
+    "softplus": softplus,
+    "sigmoid": sigmoid,
+    "tanh": tanh,
+    "identity": identity,
+}
+
+
+def get_activation(activation): # the function for a name in ACTIVATIONS, functions are passed through
+    if callable(activation):
+        return activation
+    try:
+        return ACTIVATIONS[activation]
+    except KeyError:
+        raise ValueError(f"Unknown activation {activation}, expected one of {', '.join(ACTIVATIONS)}") from None
@@ -0,0 +1,64 @@
+""" For aligning performance notes to the score using the ASAP beat annotations. """
+
+import numpy as np
+
+
+def warp_onsets(onsets, perf_beats, score_beats):
+    # maps every performance onset (in seconds) onto score time at once, piecewise-linearly between the surrounding beats.
+    # before the first beat the segment starts at 0, and past the last beat the last beat length is extrapolated (stretched
+    # to end just after the note if the note is even later than that)
+    onsets = np.asarray(onsets, dtype=float)
+    perf_beats = np.asarray(perf_beats, dtype=float)
+    score_beats = np.asarray(score_beats, dtype=float)
+    num_beats = len(perf_beats)
+
+    beat_index = np.searchsorted(perf_beats, onsets, side="right") # index of the first beat after each onset
+    past_end = beat_index == num_beats
+    inside = np.minimum(beat_index, num_beats - 1)
+    before = np.maximum(beat_index - 1, 0)
+
+    a = np.where(beat_index == 0, 0, perf_beats[before])
+    b = perf_beats[inside]
+    a_prime = np.where(beat_index == 0, 0, score_beats[before])
+    b_prime = score_beats[inside]
+
+    # past the last beat, extrapolate with the length of the last beat
+    last_perf_beat = perf_beats[-1] + (perf_beats[-1] - perf_beats[-2])
+    b = np.where(past_end, last_perf_beat, b)
+    b = np.where(past_end & (onsets > b), onsets + .01, b)
+    last_score_beat = score_beats[num_beats - 1] + (score_beats[num_beats - 1] - score_beats[num_beats - 2])
+    b_prime = np.where(past_end, last_score_beat, b_prime)
+
+    return (b_prime - a_prime) / (b - a) * (onsets - a) + a_prime
+
+
+def match_onsets(score_onsets, perf_onsets, perf_lengths, tolerance=.5):
+    # for one pitch, matches every score onset to the nearest performance onset that is at most tolerance away, skipping
+    # performance notes with no length. the same performance note can be matched by more than one score note, and ties go to
+    # the earlier performance note. returns the index into perf_onsets of each match, or -1 where nothing was close enough
+    score_onsets = np.asarray(score_onsets, dtype=float)
+    perf_onsets = np.asarray(perf_onsets, dtype=float)
+    matches = np.full(len(score_onsets), -1)
+
+    candidates = np.flatnonzero(np.asarray(perf_lengths) != 0)
+    if len(candidates) == 0 or len(score_onsets) == 0:
+        return matches
+    order = candidates[np.argsort(perf_onsets[candidates], kind="stable")]
+    sorted_onsets = perf_onsets[order]
+
+    # the nearest candidate is either the first one at or after the score onset, or the first of the run just before it
+    right = np.searchsorted(sorted_onsets, score_onsets, side="left")
+    left = np.searchsorted(sorted_onsets, sorted_onsets[np.maximum(right - 1, 0)], side="left")
+    has_right = right < len(sorted_onsets)
+    has_left = right > 0
+    right = np.minimum(right, len(sorted_onsets) - 1)
+
+    right_dist = np.where(has_right, np.abs(sorted_onsets[right] - score_onsets), np.inf)
+    left_dist = np.where(has_left, np.abs(sorted_onsets[left] - score_onsets), np.inf)
+    take_left = (left_dist < right_dist) | ((left_dist == right_dist) & (order[left] < order[right]))
+
+    best = np.where(take_left, order[left], order[right])
+    best_dist = np.where(take_left, left_dist, right_dist)
+    close_enough = best_dist <= tolerance
+    matches[close_enough] = best[close_enough]
+    return matches
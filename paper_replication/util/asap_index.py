@@ -0,0 +1,105 @@
+""" For looking up the ASAP metadata and beat annotations, only loading them when first needed.
+
+The beat index is a flat array of all the beats that lookups memory-map instead of parsing asap_annotations.json. It's only
+used while asap_annotations.json hasn't changed, and rebuilt on the first lookup when it's missing, out of date or unreadable.
+Run from paper_replication with python -m util.asap_index to build it ahead of time. """
+
+import os
+import json
+
+import numpy as np
+import pandas
+
+from util.atomic import atomic_path, write_atomic
+
+ASAP_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-master"
+PROCESSED_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed"
+
+ANNOTATIONS_PATH = os.path.join(ASAP_PATH, "asap_annotations.json")
+BEAT_INDEX_PATH = os.path.join(PROCESSED_PATH, "beat_index")
+
+_metadata = None
+_annotations = None
+_beat_index = None # (entries, beats), or False if there's no up to date index
+
+
+def metadata():
+    global _metadata
+    if _metadata is None:
+        _metadata = pandas.read_csv(os.path.join(ASAP_PATH, "metadata.csv"))
+    return _metadata
+
+
+def annotations():
+    global _annotations
+    if _annotations is None:
+        with open(ANNOTATIONS_PATH) as f:
+            _annotations = json.load(f)
+    return _annotations
+
+
+def _source_stamp(): # identifies the version of asap_annotations.json the index was built from
+    stat = os.stat(ANNOTATIONS_PATH)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def build_beat_index(index_path=BEAT_INDEX_PATH):
+    # every performance's beats then its score's beats, back to back in beats.npy. index.json has, per performance,
+    # [aligned?, start in beats.npy, number of performance beats, number of score beats]
+    entries = {}
+    all_beats = []
+    for perf_name, ann in annotations().items():
+        perf_beats, score_beats = ann["performance_beats"], ann["midi_score_beats"]
+        entries[perf_name] = [ann["score_and_performance_aligned"], len(all_beats), len(perf_beats), len(score_beats)]
+        all_beats += perf_beats + score_beats
+
+    with atomic_path(os.path.join(index_path, "beats.npy"), suffix=".npy") as tmp_path:
+        np.save(tmp_path, np.asarray(all_beats, dtype=np.float64))
+    # written last, so a half built index never looks up to date
+    write_atomic(os.path.join(index_path, "index.json"), json.dumps({"source": _source_stamp(), "entries": entries}))
+
+
+def _read_beat_index(): # (entries, beats) from disk, or None if the index is missing, out of date or unreadable
+    try:
+        with open(os.path.join(BEAT_INDEX_PATH, "index.json")) as f:
+            index = json.load(f)
+        if index["source"] != _source_stamp():
+            return None
+        return index["entries"], np.load(os.path.join(BEAT_INDEX_PATH, "beats.npy"), mmap_mode="r")
+    except (OSError, EOFError, ValueError, KeyError, TypeError): # EOFError and ValueError are a truncated index.json or beats.npy
+        return None
+
+
+def _load_beat_index():
+    global _beat_index
+    if _beat_index is None:
+        _beat_index = _read_beat_index()
+        if _beat_index is None:
+            try:
+                build_beat_index(BEAT_INDEX_PATH)
+                _beat_index = _read_beat_index()
+            except OSError: # can't write it, the lookups go through annotations() instead
+                pass
+        _beat_index = _beat_index or False
+    return _beat_index
+
+
+def is_aligned(perf_name):
+    beat_index = _load_beat_index()
+    if beat_index:
+        return beat_index[0][perf_name][0]
+    return annotations()[perf_name]["score_and_performance_aligned"]
+
+
+def beats(perf_name): # (performance beats, score beats) in seconds
+    beat_index = _load_beat_index()
+    if beat_index:
+        entries, all_beats = beat_index
+        _, start, num_perf, num_score = entries[perf_name]
+        return all_beats[start:start + num_perf], all_beats[start + num_perf:start + num_perf + num_score]
+    ann = annotations()[perf_name]
+    return np.asarray(ann["performance_beats"]), np.asarray(ann["midi_score_beats"])
+
+
+if __name__ == "__main__":
+    build_beat_index()
@@ -0,0 +1,26 @@
+""" For writing files so a crash never leaves a half written one: everything is written to a temporary file next to the path and
+only moved over it once complete. """
+
+import os
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_path(path, suffix=""):
+    # yields a temporary path to write to, moved over path when the block finishes and removed if it raises. suffix is for writers
+    # that add their own extension, like np.save adding .npy
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp{suffix}"
+    try:
+        yield tmp_path
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def write_atomic(path, text):
+    with atomic_path(path) as tmp_path:
+        with open(tmp_path, "w") as f:
+            f.write(text)
@@ -0,0 +1,100 @@
+""" For running a trained reservoir over many pieces and scoring its predictions, per piece and pooled over all of them
+(MSE, R², MAE and the MSE of just predicting 0), with every piece's targets and predictions in one contiguous array. """
+
+import numpy as np
+import pandas
+
+from reservoirpy.nodes import ESN # type: ignore
+
+from util.load_data import collapse_repeats
+
+
+def run_pieces(model, pieces):
+    # {piece: predictions} for {piece: inputs}, each piece run from a reset state. an ESN gets all of them in one run call, which
+    # spreads them over its workers, anything else runs them one after the other
+    names = list(pieces)
+    inputs = [np.asarray(pieces[name]) for name in names]
+    if isinstance(model, ESN) and len(inputs) > 1:
+        outputs = model.run(inputs, reset=True)
+    else:
+        outputs = [model.run(x, reset=True) for x in inputs]
+    return dict(zip(names, outputs))
+
+
+def _piece_sums(a, offsets): # the sum of a over each piece, piece i being a[offsets[i]:offsets[i + 1]]
+    starts = np.minimum(offsets[:-1], max(len(a) - 1, 0))
+    sums = np.add.reduceat(a, starts) if len(a) else np.zeros(len(starts))
+    return np.where(np.diff(offsets) > 0, sums, 0.)
+
+
+def metrics(predicted, target, offsets):
+    # (per piece {metric: array}, pooled {metric: value}) for predictions and targets of all the pieces back to back, piece i
+    # being rows offsets[i] to offsets[i + 1]. mse and r2 are defined like reservoirpy's mse and rsquare, zero_mse is the MSE of
+    # always predicting 0
+    predicted = np.asarray(predicted, dtype=float)
+    target = np.asarray(target, dtype=float)
+    offsets = np.asarray(offsets)
+    notes = np.diff(offsets)
+
+    squared_error = (target - predicted) ** 2
+    absolute_error = np.abs(target - predicted)
+    squared_target = target ** 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        piece_mean = _piece_sums(target, offsets) / notes
+    squared_deviation = (target - np.repeat(piece_mean, notes)) ** 2
+
+    sums = {name: _piece_sums(a, offsets) for name, a in [("se", squared_error), ("ae", absolute_error), ("st", squared_target), ("sd", squared_deviation)]}
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_piece = {
+            "notes": notes,
+            "mse": sums["se"] / notes,
+            "r2": 1 - sums["se"] / sums["sd"],
+            "mae": sums["ae"] / notes,
+            "zero_mse": sums["st"] / notes,
+        }
+        pooled = {
+            "notes": len(target),
+            "mse": squared_error.sum() / len(target),
+            "r2": 1 - squared_error.sum() / ((target - target.mean()) ** 2).sum(),
+            "mae": absolute_error.sum() / len(target),
+            "zero_mse": squared_target.sum() / len(target),
+        }
+    return per_piece, pooled
+
+
+def score_pieces(predictions, targets, column=0, repeats=1):
+    # (one row per piece with its metrics, pooled metrics over all the notes), see metrics, for one output column. with repeats,
+    # predictions are averaged back down with collapse_repeats first, targets aren't repeated then
+    names = list(predictions)
+    predicted = [collapse_repeats(np.asarray(predictions[name])[:, column], repeats) for name in names]
+    target = [np.asarray(targets[name], dtype=float)[:, column] for name in names]
+    for name, p, t in zip(names, predicted, target):
+        if len(p) != len(t):
+            raise ValueError(f"{name} has {len(p)} predictions for {len(t)} targets")
+
+    offsets = np.concatenate([[0], np.cumsum([len(t) for t in target])]).astype(int)
+    per_piece, pooled = metrics(np.concatenate(predicted or [[]]), np.concatenate(target or [[]]), offsets)
+    return pandas.DataFrame({"piece": names, **per_piece}), pooled
+
+
+def evaluate(model, pieces, targets, column=0, repeats=1):
+    # (score_pieces table, pooled metrics, {piece: predictions}) of running model on pieces
+    predictions = run_pieces(model, pieces)
+    return (*score_pieces(predictions, targets, column, repeats), predictions)
+
+
+def ridge_sweep(solver, states, targets, ridges, column=0, repeats=1):
+    # one row per ridge value with the mean of the per-piece mse and r2 (what the tuning calls loss and r2) and the pooled
+    # metrics, for the readouts of a util.state_cache.RidgeSolver on {piece: reservoir states}
+    predictions = {name: solver.predict(piece_states, ridges) for name, piece_states in states.items()}
+
+    rows = []
+    for i, ridge in enumerate(ridges):
+        per_piece, pooled = score_pieces({name: predicted[i] for name, predicted in predictions.items()}, targets, column, repeats)
+        rows.append({
+            "ridge": ridge,
+            "loss": per_piece["mse"].mean(),
+            "r2": per_piece["r2"].mean(),
+            **{f"pooled_{metric}": value for metric, value in pooled.items() if metric != "notes"},
+        })
+    return pandas.DataFrame(rows)
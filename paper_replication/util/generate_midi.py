@@ -1,20 +1,15 @@
-""" For applying the outputs of the model into the original parsed MIDI -> txt files, to create the more realistic files. """
-
-import os
-import json
+""" For applying the outputs of the model into the original parsed MIDI -> note tables, to create the more realistic files. """
 
 import numpy as np
-import pandas
 import mido
 
+from util.note_table import read_note_table
+
 
 ASAP_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-master"
 PROCESSED_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed"
 
-METADATA = pandas.read_csv(os.path.join(ASAP_PATH, "metadata.csv"))
-ASAP_ANNOTATIONS = json.load(open(os.path.join(ASAP_PATH, "asap_annotations.json")))
-
-def apply_outputs(path_to_txt, path_to_save, velocities, lengths):
+def apply_outputs(path_to_table, path_to_save, velocities, lengths):
     mf = mido.MidiFile()
     track = mido.MidiTrack()
     mf.tracks.append(track)
@@ -27,12 +22,9 @@ def apply_outputs(path_to_txt, path_to_save, velocities, lengths):
     track.append(mido.Message(type="control_change", channel=0, control=91, value=0, time=0)) # "Depth 1" 
     track.append(mido.Message(type="control_change", channel=0, control=93, value=0, time=0)) # "Depth 2"
 
-    with open(path_to_txt) as f:
-        lines = f.read().splitlines()
+    table = read_note_table(path_to_table)
     events = []
-    for i, line in enumerate(lines):
-        note, offset, _, _, _, _, length, _ = line.split('\t')
-        note, offset, length = int(note), float(offset), float(length)
+    for i, (note, offset, length) in enumerate(zip(table["note"].tolist(), table["time"].tolist(), table["len_m"].tolist())):
         events.append([offset, note, min(max(round(float(velocities[i])*1.7) + 65, 1),127)])
         events.append([offset + float(lengths[i]), note, 0])
     
@@ -1,37 +1,121 @@
+import os
 import json
 import pandas
 import random
-import copy
+from collections.abc import Mapping
 
-# handles getting the features from the processed/aligned data along with extract_features, where the processed data is made in
-# process_midi
-def prepare_dataset(data_path, metadata_path, columns_with_hist, columns_without_hist, goal_columns, test_data_only = False, train_by_piece = False, val_by_piece=False, sample_repeats = 1):
+import numpy as np
+
+from util.piece_features import ColumnStore, ColumnStoreWriter, iter_pieces, history_columns, lag, HISTORY_COLUMNS
+
+SPLIT_CACHE_VERSION = 1 # bump when split_performances changes
+VAL_FRACTION = 0.15 # of each composer's notes, for validation and for testing each
+SPLIT_SEED = 4
+SPLIT_CACHE_ENTRIES = 8 # how many splits dataset_cache/splits.json keeps, the oldest written go first
+EXCLUDED_PIECES = ["Mozart Fantasie_475"] # "composer title" of pieces never used, this one is out of place
+
+_stores = {} # data path -> (stamp, ColumnStore), so repeated prepare_dataset calls share the memory-mapped columns
+_splits = {} # split cache key -> split, see split_performances
+_metadata_indexes = {} # metadata path -> (stamp, index), see metadata_index
+
+
+def _stamp(path): # identifies the version of a file, or of a column store by its index.json
+    stat = os.stat(os.path.join(path, "index.json") if os.path.isdir(path) else path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _cache_dir(data_path): # dataset_cache/ next to the features
+    return os.path.join(os.path.dirname(os.path.abspath(data_path)), "dataset_cache")
+
+
+def open_features(data_path):
+    # the features at data_path as a ColumnStore. a .json or .jsonl file is converted to a column store in dataset_cache/ the first
+    # time, and that copy is used for as long as the file doesn't change
+    data_path = os.path.abspath(data_path)
+    stamp = _stamp(data_path)
+    if data_path in _stores and _stores[data_path][0] == stamp:
+        return _stores[data_path][1]
+
+    if os.path.isdir(data_path):
+        store = ColumnStore(data_path)
+    else:
+        store_path = os.path.join(_cache_dir(data_path), os.path.basename(data_path) + ".store")
+        source_path = store_path + ".json"
+        try:
+            with open(source_path) as f:
+                up_to_date = json.load(f) == {"source": data_path, "stamp": stamp}
+        except FileNotFoundError:
+            up_to_date = False
+
+        if not up_to_date:
+            print(f"Converting {data_path} to a column store...")
+            with ColumnStoreWriter(store_path) as writer:
+                for name, features in iter_pieces(data_path):
+                    writer.write(name, features)
+            with open(source_path, "w") as f: # written last, so a half written store never looks up to date
+                json.dump({"source": data_path, "stamp": stamp}, f)
+        store = ColumnStore(store_path)
+
+    _stores[data_path] = (stamp, store)
+    return store
+
+
+def metadata_index(metadata_path): # {midi_performance: (composer, title)}, read once per version of the metadata file
+    metadata_path = os.path.abspath(metadata_path)
+    stamp = _stamp(metadata_path)
+    if metadata_path not in _metadata_indexes or _metadata_indexes[metadata_path][0] != stamp:
+        df = pandas.read_csv(metadata_path)
+        _metadata_indexes[metadata_path] = (stamp, dict(zip(df["midi_performance"], zip(df["composer"], df["title"]))))
+    return _metadata_indexes[metadata_path][1]
+
+
+def split_performances(data_path, metadata_path, composers=("Bach",)):
+    # ({performance: "composer piece"}, train pieces, val pieces, test pieces), only for the given composers (all if None). the
+    # pieces of each composer are split by number of notes, every performance of a piece going the same way. performances that
+    # aren't used have no entry. cached in memory and in dataset_cache/splits.json for as long as the features, the metadata and
+    # the split settings stay the same
+    composers = None if composers is None else sorted(composers)
+    key = json.dumps([SPLIT_CACHE_VERSION, os.path.abspath(data_path), _stamp(data_path), os.path.abspath(metadata_path), _stamp(metadata_path), VAL_FRACTION, SPLIT_SEED, EXCLUDED_PIECES, composers])
+    if key in _splits:
+        return _splits[key]
 
-    data = json.load(open(data_path))
-    df = pandas.read_csv(metadata_path)
+    cache_path = os.path.join(_cache_dir(data_path), "splits.json")
+    try:
+        with open(cache_path) as f:
+            cached = json.load(f)
+    except FileNotFoundError:
+        cached = {}
+    if key in cached:
+        _splits[key] = cached[key]
+        return cached[key]
 
-    columns = columns_with_hist + columns_without_hist + [f"-1_{col}" for col in columns_with_hist]
+    store = open_features(data_path)
+    index = metadata_index(metadata_path)
 
+    labels = {}
     composers_pieces = {}
     composers_total = {}
 
-    for perf_name in data:
-        md = df.loc[df['midi_performance'] == perf_name].values
-        if f"{md[0][0]} {md[0][1]}" == "Mozart Fantasie_475":
-            continue # Skip this piece, it's out of place
+    for i, perf_name in enumerate(store.pieces):
+        composer, title = index[perf_name]
+        if f"{composer} {title}" in EXCLUDED_PIECES:
+            continue
 
-        if md[0][0] != "Bach":
-            continue # Skip, not Bach
+        if composers is not None and composer not in composers:
+            continue
 
-        if md[0][0] not in composers_pieces:
-            composers_pieces[md[0][0]] = {}
-            composers_total[md[0][0]] = 0
+        labels[perf_name] = f"{composer} {title}"
+        length = int(store.offsets[i + 1] - store.offsets[i])
+
+        if composer not in composers_pieces:
+            composers_pieces[composer] = {}
+            composers_total[composer] = 0
         
-        if md[0][1] not in composers_pieces[md[0][0]]:
-            composers_pieces[md[0][0]][md[0][1]] = len(data[perf_name]['Note'])
+        if title not in composers_pieces[composer]:
+            composers_pieces[composer][title] = length
         else:
-            composers_pieces[md[0][0]][md[0][1]] += len(data[perf_name]['Note'])
-        composers_total[md[0][0]] += len(data[perf_name]['Note'])
+            composers_pieces[composer][title] += length
+        composers_total[composer] += length
 
     train_pieces, val_pieces, test_pieces = [], [], []
 
@@ -39,13 +123,13 @@ def prepare_dataset(data_path, metadata_path, columns_with_hist, columns_without
         pieces = [[], [], []]
         totals = [0, 0, 0]
 
-        num_val_samples = int(0.15 * composers_total[composer])
+        num_val_samples = int(VAL_FRACTION * composers_total[composer])
         num_train_samples = composers_total[composer] - (2 * num_val_samples)
         
         goals = [num_train_samples, num_val_samples, num_val_samples]
 
         sorted_pieces = sorted(composers_pieces[composer].items(), key=lambda x:x[1], reverse=True)
-        random.Random(4).shuffle(sorted_pieces)
+        random.Random(SPLIT_SEED).shuffle(sorted_pieces)
         counter = 0
         for piece, length in sorted_pieces:
             for i in range(3):
@@ -66,75 +150,234 @@ def prepare_dataset(data_path, metadata_path, columns_with_hist, columns_without
         val_pieces.extend(pieces[1])
         test_pieces.extend(pieces[2])
 
-    train_samples, val_samples, test_samples, train_samples_by_piece, val_samples_by_piece, test_samples_by_piece = {}, {}, {}, {}, {}, {}
+    split = [labels, train_pieces, val_pieces, test_pieces]
 
-    for perf_name in data:
-        md = df.loc[df['midi_performance'] == perf_name].values
-        if f"{md[0][0]} {md[0][1]}" == "Mozart Fantasie_475":
-            continue # Skip this piece, it's out of place
+    cached[key] = split # after the others, so stale splits (from before the features or metadata changed) are the first dropped
+    for old_key in list(cached)[:-SPLIT_CACHE_ENTRIES]:
+        del cached[old_key]
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cached, f)
+    os.replace(tmp_path, cache_path)
 
-        if md[0][0] != "Bach":
-            continue # Skip, not Bach
-        
-        data_wanted = {k: [w for w in v for _ in range(sample_repeats)] for k, v in data[perf_name].items() if k in columns}
-        
-        if f"{md[0][0]} {md[0][1]}" in train_pieces:
-            train_samples_by_piece[perf_name] = copy.deepcopy(data_wanted)
-            if not train_samples:
-                train_samples = data_wanted
-                continue
-            for k in data_wanted:
-                train_samples[k] += data_wanted[k]
-        elif f"{md[0][0]} {md[0][1]}" in val_pieces:
-            val_samples_by_piece[perf_name] = copy.deepcopy(data_wanted)
-            if not val_samples:
-                val_samples = data_wanted
-                continue
-            for k in data_wanted:
-                val_samples[k] += data_wanted[k]
-        elif f"{md[0][0]} {md[0][1]}" in test_pieces:
-            test_samples_by_piece[perf_name] = copy.deepcopy(data_wanted) # Otherwise the first piece becomes huge. No idea why, investigate?
-            if not test_samples:
-                test_samples = data_wanted
-                continue
-            for k in data_wanted:
-                test_samples[k] += data_wanted[k]
-        
-        else:
-            print(f"Missing piece! {md[0][0]} {md[0][1]}")
-        
-    train_df, val_df, test_df = list(map(pandas.DataFrame, [train_samples, val_samples, test_samples]))
-    
-    test_dfs = {piece_name: pandas.DataFrame(samples) for piece_name, samples in test_samples_by_piece.items()}
-    val_dfs = {piece_name: pandas.DataFrame(samples) for piece_name, samples in val_samples_by_piece.items()}
-    train_dfs = {piece_name: pandas.DataFrame(samples) for piece_name, samples in train_samples_by_piece.items()}
-    test_gs = {}
-    val_gs = {}
-    train_gs = {}
-
-    train_targets = pandas.concat([train_df.pop(x) for x in goal_columns], axis=1)
-    val_targets = pandas.concat([val_df.pop(x) for x in goal_columns], axis=1)
-    test_targets = pandas.concat([test_df.pop(x) for x in goal_columns], axis=1)
-    for d in test_dfs:
-        test_gs[d] = pandas.concat([test_dfs[d].pop(x) for x in goal_columns], axis=1)
-    for d in val_dfs:
-        val_gs[d] = pandas.concat([val_dfs[d].pop(x) for x in goal_columns], axis=1)
-    for d in train_dfs:
-        train_gs[d] = pandas.concat([train_dfs[d].pop(x) for x in goal_columns], axis=1)
-
-    print(train_df.shape[0], val_df.shape[0], test_df.shape[0])
+    _splits[key] = split
+    return split
 
-    if test_data_only:
-        return test_dfs, test_gs
 
-    returnitems = []
+def repeat_rows(a, repeats): # each row of a repeated repeats times, the expansion sample_repeats stands for
+    return a if repeats == 1 else np.repeat(a, repeats, axis=0)
 
-    if train_by_piece:
-        returnitems += [train_dfs, train_gs]
-    else:
-        returnitems += [train_df, train_targets]
-    if val_by_piece:
-        returnitems += [val_dfs, val_gs]
-    else:
-        returnitems += [val_df, val_targets]
-    return returnitems + [test_df, test_targets]
+
+def collapse_repeats(a, repeats): # the mean of each run of repeats rows, undoing repeat_rows for e.g. predictions
+    a = np.asarray(a)
+    return a if repeats == 1 else a.reshape(-1, repeats, *a.shape[1:]).mean(axis=1)
+
+
+class RepeatedPieces(Mapping):
+    # {performance: array} that expands each performance's rows with repeat_rows only when it's looked up, so the repeated data is
+    # never all in memory at once
+    def __init__(self, views, repeats):
+        self.views = views
+        self.repeats = repeats
+
+    def __getitem__(self, name):
+        return repeat_rows(self.views[name], self.repeats)
+
+    def __iter__(self):
+        return iter(self.views)
+
+    def __len__(self):
+        return len(self.views)
+
+
+class RepeatedRows:
+    # a whole split's matrix with each row repeated repeats times, without the copies. looking rows up maps them back to rows of
+    # the matrix, and only np.asarray (or anything else that needs the whole array) expands it with repeat_rows
+    def __init__(self, a, repeats):
+        self.a = a
+        self.repeats = repeats
+        self.shape = (len(a) * repeats, *a.shape[1:])
+        self.dtype = a.dtype
+        self.ndim = a.ndim
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, index):
+        rows, *rest = index if isinstance(index, tuple) else (index,)
+        if isinstance(rows, (slice, int, np.integer)):
+            rows = range(len(self))[rows] # negative indices and bounds checks like a list
+            rows = rows // self.repeats if isinstance(rows, int) else np.arange(rows.start, rows.stop, rows.step) // self.repeats
+        else: # index arrays and masks
+            rows = np.arange(len(self))[rows] // self.repeats
+        return self.a[(rows, *rest)]
+
+    def __array__(self, dtype=None, copy=None):
+        a = repeat_rows(np.asarray(self.a), self.repeats)
+        return a if dtype is None else a.astype(dtype, copy=False)
+
+
+class SplitArrays:
+    # one split as a feature matrix and a target matrix, the performances back to back. performance i has rows offsets[i] to
+    # offsets[i + 1], and the per-performance arrays are views of these. sample_repeats isn't applied to the matrices, it's kept as
+    # repeats and only expanded per performance by repeated_by_piece, or row by row by repeated
+    def __init__(self, features, targets, columns, goal_columns, pieces, offsets, repeats=1):
+        self.features = features
+        self.targets = targets
+        self.columns = columns
+        self.goal_columns = goal_columns
+        self.pieces = pieces
+        self.offsets = offsets
+        self.repeats = repeats
+        self.piece_index = {name: i for i, name in enumerate(pieces)}
+
+    def piece(self, name): # (features, targets) of one performance, as views
+        i = self.piece_index[name]
+        return self.features[self.offsets[i]:self.offsets[i + 1]], self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def by_piece(self): # ({performance: features}, {performance: targets}), as views
+        views = {name: self.piece(name) for name in self.pieces}
+        return {name: v[0] for name, v in views.items()}, {name: v[1] for name, v in views.items()}
+
+    def repeated_by_piece(self, pieces=None):
+        # by_piece with the rows repeated, expanded a performance at a time as they're looked up. pieces picks the performances and
+        # their order, all of them in split order by default
+        features, targets = self.by_piece()
+        pieces = self.pieces if pieces is None else pieces
+        return RepeatedPieces({name: features[name] for name in pieces}, self.repeats), RepeatedPieces({name: targets[name] for name in pieces}, self.repeats)
+
+    def repeated(self): # (features, targets) of the whole split with the rows repeated, as RepeatedRows (no repeats, the matrices)
+        if self.repeats == 1:
+            return self.features, self.targets
+        return RepeatedRows(self.features, self.repeats), RepeatedRows(self.targets, self.repeats)
+
+
+def prepare_arrays(data_path, metadata_path, columns_with_hist, columns_without_hist, goal_columns, sample_repeats = 1, composers=("Bach",), dtype=np.float32, history=1, lagged=HISTORY_COLUMNS, splits=("train", "val", "test")):
+    # the same train, val and test data as prepare_dataset, as SplitArrays. each matrix is filled a column at a time straight from
+    # the column store, with the columns in the same order as prepare_dataset's DataFrames. only the splits named in splits are
+    # read, the others come back as None
+    columns = columns_with_hist + columns_without_hist
+
+    store = open_features(data_path)
+    labels, train_pieces, val_pieces, test_pieces = split_performances(data_path, metadata_path, composers)
+    lags = history_columns([column for column in store.columns if column in columns_with_hist], history, lagged)
+
+    missing = [column for column in goal_columns if column not in columns or column not in store.columns]
+    if missing:
+        raise KeyError(f"Goal columns {missing} aren't among the loaded columns")
+    feature_columns = [column for column in store.columns if column in columns and column not in goal_columns]
+    feature_lags = [(name, column, k) for name, column, k in lags if name not in goal_columns]
+
+    arrays = []
+    for split_name, split_pieces in zip(["train", "val", "test"], [train_pieces, val_pieces, test_pieces]):
+        if split_name not in splits:
+            arrays.append(None)
+            continue
+        split_pieces = set(split_pieces)
+        pieces = [perf_name for perf_name, label in labels.items() if label in split_pieces]
+        starts = np.array([store.offsets[store.piece_index[name]] for name in pieces], dtype=np.int64)
+        ends = np.array([store.offsets[store.piece_index[name] + 1] for name in pieces], dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(ends - starts)])
+
+        # the row of the store for every row of the split
+        rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] or [np.zeros(0, dtype=np.int64)])
+
+        # how far each row is into its performance, a -k_ history column is 0 for the first k rows and the row k back otherwise
+        position = np.arange(len(rows)) - np.repeat(offsets[:-1], ends - starts)
+
+        features = np.empty((len(rows), len(feature_columns) + len(feature_lags)), dtype=dtype)
+        for j, column in enumerate(feature_columns):
+            features[:, j] = store.column(column)[rows]
+        for j, (name, column, k) in enumerate(feature_lags, len(feature_columns)):
+            features[:, j] = np.where(position >= k, store.column(column)[np.maximum(rows - k, 0)], 0)
+        targets = np.empty((len(rows), len(goal_columns)), dtype=dtype)
+        for j, column in enumerate(goal_columns):
+            targets[:, j] = store.column(column)[rows]
+
+        arrays.append(SplitArrays(features, targets, feature_columns + [name for name, _, _ in feature_lags], list(goal_columns), pieces, offsets, sample_repeats))
+
+    print(*(len(split.features) * sample_repeats for split in arrays if split is not None))
+    return arrays
+
+class PieceFrames(Mapping):
+    # {performance: DataFrame} for prepare_dataset, each made from the performance's {column: values} with the rows repeated only
+    # when it's looked up, like RepeatedPieces. the DataFrames have columns, in the order of the pieces' columns
+    def __init__(self, pieces, columns, repeats):
+        self.pieces = pieces
+        self.columns = columns
+        self.repeats = repeats
+
+    def __getitem__(self, name):
+        piece = self.pieces[name]
+        return pandas.DataFrame({k: np.repeat(np.asarray(piece[k]), self.repeats) for k in self.columns})
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __len__(self):
+        return len(self.pieces)
+
+
+# handles getting the features from the processed/aligned data along with extract_features, where the processed data is made in
+# process_midi
+def prepare_dataset(data_path, metadata_path, columns_with_hist, columns_without_hist, goal_columns, test_data_only = False, train_by_piece = False, val_by_piece=False, sample_repeats = 1, composers=("Bach",), as_numpy=False, history=1, lagged=HISTORY_COLUMNS):
+    # with as_numpy, everything comes back as float32 arrays (views of one matrix per split, see prepare_arrays) instead of
+    # DataFrames, in the same layout. the by-piece dicts repeat each performance's rows only when it's looked up, and the whole
+    # splits are RepeatedRows, so nothing is held more than once whatever sample_repeats is. without as_numpy the by-piece
+    # DataFrames are also made as they're looked up, but a whole split DataFrame has to hold sample_repeats copies of every row,
+    # use as_numpy or prepare_arrays for those. with test_data_only the train and val splits aren't read at all.
+    # columns_with_hist also get -1_ to -{history}_ history columns, made here from the stored columns (only for the ones in
+    # lagged, all of them if None), see util.piece_features.history_columns
+
+    if as_numpy:
+        train, val, test = prepare_arrays(data_path, metadata_path, columns_with_hist, columns_without_hist, goal_columns, sample_repeats, composers, history=history, lagged=lagged,
+                                          splits=("test",) if test_data_only else ("train", "val", "test"))
+        if test_data_only:
+            return test.repeated_by_piece()
+        return [
+            *(train.repeated_by_piece() if train_by_piece else train.repeated()),
+            *(val.repeated_by_piece() if val_by_piece else val.repeated()),
+            *test.repeated()
+        ]
+
+    columns = columns_with_hist + columns_without_hist
+
+    store = open_features(data_path) # shared between calls, only the columns used get read
+    lags = history_columns([column for column in store.columns if column in columns_with_hist], history, lagged)
+    labels, train_pieces, val_pieces, test_pieces = split_performances(data_path, metadata_path, composers)
+    piece_splits = {label: i for i, pieces in enumerate([train_pieces, val_pieces, test_pieces]) for label in pieces} # 0 train, 1 val, 2 test
+    wanted = [2] if test_data_only else [0, 1, 2]
+
+    split_pieces = [{}, {}, {}] # train, val, test {performance: {column: values}}, not repeated
+    for perf_name, label in labels.items():
+        split = piece_splits.get(label)
+        if split is None:
+            print(f"Missing piece! {label}")
+            continue
+        if split not in wanted:
+            continue
+        piece = store.piece(perf_name, columns)
+        piece.update({name: lag(piece[column], k) for name, column, k in lags})
+        split_pieces[split][perf_name] = piece
+
+    piece_columns = next((list(piece) for pieces in split_pieces for piece in pieces.values()), [])
+    feature_columns = [column for column in piece_columns if column not in goal_columns]
+
+    def by_piece(pieces): # ({performance: features}, {performance: targets}) DataFrames, made as they're looked up
+        return PieceFrames(pieces, feature_columns, sample_repeats), PieceFrames(pieces, goal_columns, sample_repeats)
+
+    def whole(pieces): # the performances back to back, as features and targets DataFrames with the rows repeated
+        return [pandas.DataFrame({k: np.repeat(np.concatenate([np.asarray(piece[k]) for piece in pieces.values()] or [[]]), sample_repeats) for k in frame_columns})
+                for frame_columns in [feature_columns, goal_columns]]
+
+    print(*(sum(len(piece[piece_columns[0]]) for piece in split_pieces[split].values()) * sample_repeats for split in wanted))
+
+    if test_data_only:
+        return by_piece(split_pieces[2])
+
+    return [
+        *(by_piece(split_pieces[0]) if train_by_piece else whole(split_pieces[0])),
+        *(by_piece(split_pieces[1]) if val_by_piece else whole(split_pieces[1])),
+        *whole(split_pieces[2])
+    ]
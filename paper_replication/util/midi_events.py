@@ -0,0 +1,42 @@
+""" For decoding MIDI files into arrays of notes. """
+
+import numpy as np
+
+# one row per played note. offset is nan if the note never got a note_off, voices is how many notes were held down at the onset
+# (including this one)
+NOTE_DTYPE = np.dtype([
+    ("onset", np.float64),
+    ("offset", np.float64),
+    ("pitch", np.int16),
+    ("velocity", np.int16),
+    ("channel", np.int16),
+    ("voices", np.int32),
+])
+
+
+def decode_midi(mf): # turns a mido.MidiFile into a NOTE_DTYPE array, in order of note_on
+    notes = []
+    playing = {} # pitch -> index in notes of the note holding it down
+
+    time = 0
+    for msg in mf:
+        time += msg.time
+
+        if msg.type == "note_on" and msg.velocity > 0:
+            if msg.note in playing:
+                continue # DOUBLE NOTE, keep the one already held
+            playing[msg.note] = len(notes)
+            notes.append([time, np.nan, msg.note, msg.velocity, msg.channel, len(playing)])
+        elif msg.type == "note_on" or msg.type == "note_off":
+            index = playing.pop(msg.note, None)
+            if index is None:
+                continue # DOUBLE END_NOTE
+            notes[index][1] = time
+
+    return np.array([tuple(note) for note in notes], dtype=NOTE_DTYPE)
+
+
+def note_lengths(notes, unfinished=0.): # length of each note, with unfinished for notes that never got a note_off
+    lengths = notes["offset"] - notes["onset"]
+    lengths[np.isnan(lengths)] = unfinished
+    return lengths
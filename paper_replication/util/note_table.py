@@ -0,0 +1,85 @@
+""" For saving and loading the processed note tables (one per performance) as typed columns in a .npz file.
+
+Run from paper_replication with python -m util.note_table to convert the old tab separated .txt outputs in PROCESSED_PATH. """
+
+import os
+import zipfile
+
+import numpy as np
+
+from util.atomic import atomic_path
+
+PROCESSED_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed"
+
+# the columns of parse_midi's all_notes_and_data, in order. voices is 0 where the score note never got a note_off
+COLUMNS = [
+    ("note", np.int16),
+    ("time", np.float64),
+    ("matched", np.bool_),
+    ("velocity", np.int16),
+    ("flat_index", np.int32),
+    ("len_p", np.float64),
+    ("len_m", np.float64),
+    ("voices", np.int32),
+]
+
+
+def write_note_table(path, rows): # rows are parse_midi's all_notes_and_data
+    columns = list(zip(*rows)) if rows else [[]] * len(COLUMNS)
+    save_columns(path, {name: np.asarray(column, dtype=float if dtype != np.bool_ else None).astype(dtype) for (name, dtype), column in zip(COLUMNS, columns)})
+
+
+def save_columns(path, table): # written atomically (see util.atomic), so a crash never leaves a half written file
+    with atomic_path(path) as tmp_path:
+        # same as np.savez_compressed, but with fixed timestamps so the same table always gives the same bytes
+        with zipfile.ZipFile(tmp_path, "w") as npz:
+            for name, column in table.items():
+                info = zipfile.ZipInfo(f"{name}.npy", date_time=(1980, 1, 1, 0, 0, 0))
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with npz.open(info, "w", force_zip64=True) as f:
+                    np.lib.format.write_array(f, np.asanyarray(column), allow_pickle=False)
+
+
+def read_txt_table(path): # reads one of the old tab separated outputs into the same columns
+    with open(path) as f:
+        rows = [line.split("\t") for line in f.read().splitlines()]
+    if rows and len(rows[0]) != len(COLUMNS):
+        raise ValueError(f"{path} has {len(rows[0])} columns, expected {len(COLUMNS)}")
+
+    columns = list(zip(*rows)) if rows else [[]] * len(COLUMNS)
+    table = {}
+    for (name, dtype), column in zip(COLUMNS, columns):
+        if name == "matched":
+            table[name] = np.array([x == "True" for x in column], dtype=dtype)
+        elif name == "voices":
+            table[name] = np.array([0 if x == "False" else int(x) for x in column], dtype=dtype)
+        else:
+            table[name] = np.array(column, dtype=np.float64).astype(dtype)
+    return table
+
+
+def read_note_table(path):
+    # returns {column name: array}. falls back to the old .txt next to path if there's no .npz yet
+    if not os.path.exists(path) and os.path.exists(os.path.splitext(path)[0] + ".txt"):
+        return read_txt_table(os.path.splitext(path)[0] + ".txt")
+    with np.load(path) as npz:
+        return {name: npz[name] for name, _ in COLUMNS}
+
+
+def convert_txt(path): # writes the .npz version of an old .txt output next to it
+    save_columns(os.path.splitext(path)[0] + ".npz", read_txt_table(path))
+
+
+if __name__ == "__main__":
+    converted, skipped = 0, 0
+    for dirpath, _, filenames in os.walk(PROCESSED_PATH):
+        for filename in filenames:
+            if filename.endswith(".txt"):
+                path = os.path.join(dirpath, filename)
+                try:
+                    convert_txt(path)
+                    converted += 1
+                except ValueError as e: # not a note table (or a broken one), the rest still get converted
+                    print(f"Skipped {path}: {e}")
+                    skipped += 1
+    print(f"Converted {converted} files, skipped {skipped}.")
@@ -0,0 +1,189 @@
+""" For writing and reading the per-piece feature tables made by extract_features.
+
+They're either one JSON document {piece: {column: values}} (shifted_by_piece.json), JSON lines with one
+{"piece": piece, "features": {column: values}} per line (shifted_by_piece.jsonl), or a column store (shifted_by_piece/) with
+one .npy per column, all pieces back to back, and an index.json with the columns and where each piece starts. The column store
+can be read a few columns at a time without touching the rest.
+
+The history columns (-k_{column}, the column shifted k notes later) aren't stored, they're made when loading, see
+history_columns. Files from before still have -1_ copies, which are just not read. """
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+HISTORY_COLUMNS = ["Note", "Exact_L", "Exact_H", "Motion", "Micro", "Macro"] # the columns that used to be stored with a -1_ copy
+
+
+def history_columns(columns, depth=1, lagged=HISTORY_COLUMNS):
+    # [(name, column, k)] for the -k_ history columns of columns, k from 1 to depth, for the ones in lagged (all of columns if
+    # None). in the order the -1_ columns used to be stored in, so models trained on those get the same inputs
+    return [(f"-{k}_{column}", column, k) for k in range(1, depth + 1) for column in (columns if lagged is None else lagged) if column in columns]
+
+
+def lag(values, k): # values shifted k notes later, starting with k zeros
+    values = np.asarray(values)
+    return np.concatenate([np.zeros(min(k, len(values))), values[:max(len(values) - k, 0)]])
+
+
+def with_history(piece, depth=1, lagged=HISTORY_COLUMNS): # piece with its history columns added, see history_columns
+    timeshifted = {key: val for key, val in piece.items()}
+    timeshifted.update({name: lag(piece[column], k).tolist() for name, column, k in history_columns(list(piece), depth, lagged)})
+    return timeshifted
+
+
+class PieceWriter:
+    # writes pieces to a .jsonl file as they come. everything goes to a temporary file that only replaces path on close, so an
+    # interrupted run leaves the last complete file in place
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(self.tmp_path, "w")
+
+    def write(self, name, features):
+        self.file.write(json.dumps({"piece": name, "features": features}))
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+            os.remove(self.tmp_path)
+
+
+class ColumnStoreWriter:
+    # same interface as PieceWriter, for a column store. each column is appended to a raw file as pieces come, and only turned into
+    # .npy files on close. everything goes to a temporary directory that only replaces path on close
+    def __init__(self, path):
+        self.path = path.rstrip(os.sep)
+        self.tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        if os.path.exists(self.tmp_path):
+            shutil.rmtree(self.tmp_path)
+        os.makedirs(self.tmp_path)
+        self.columns = None # column name -> [filename, dtype, open raw file]
+        self.pieces = []
+        self.offsets = [0]
+
+    def write(self, name, features):
+        if self.columns is None: # the first piece decides the columns and their types
+            self.columns = {column: [f"{i:03d}.npy", np.asarray(values).dtype, open(os.path.join(self.tmp_path, f"{i:03d}.raw"), "wb")]
+                            for i, (column, values) in enumerate(features.items())}
+        if features.keys() != self.columns.keys():
+            raise ValueError(f"{name} has columns {list(features)}, expected {list(self.columns)}")
+
+        lengths = {len(values) for values in features.values()}
+        if len(lengths) != 1:
+            raise ValueError(f"{name} has columns of different lengths {sorted(lengths)}")
+
+        for column, values in features.items():
+            _, dtype, raw = self.columns[column]
+            raw.write(np.asarray(values).astype(dtype, casting="same_kind").tobytes())
+        self.pieces.append(name)
+        self.offsets.append(self.offsets[-1] + lengths.pop())
+
+    def _finish_columns(self): # turns the raw files into .npy files
+        for filename, dtype, raw in (self.columns or {}).values():
+            raw.close()
+            raw_path = os.path.join(self.tmp_path, filename[:-4] + ".raw")
+            with open(os.path.join(self.tmp_path, filename), "wb") as f, open(raw_path, "rb") as raw:
+                np.lib.format.write_array_header_1_0(f, {"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": (self.offsets[-1],)})
+                shutil.copyfileobj(raw, f)
+            os.remove(raw_path)
+
+    def close(self):
+        self._finish_columns()
+        with open(os.path.join(self.tmp_path, "index.json"), "w") as f:
+            json.dump({
+                "columns": {column: filename for column, (filename, _, _) in (self.columns or {}).items()},
+                "pieces": self.pieces,
+                "offsets": self.offsets,
+            }, f)
+
+        old_path = f"{self.path}.{os.getpid()}.old"
+        if os.path.exists(self.path):
+            os.rename(self.path, old_path)
+        os.rename(self.tmp_path, self.path)
+        if os.path.exists(old_path):
+            shutil.rmtree(old_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            for _, _, raw in (self.columns or {}).values():
+                raw.close()
+            shutil.rmtree(self.tmp_path)
+
+
+class ColumnStore:
+    # a column store opened for reading. columns are memory-mapped when first asked for, so only the ones used get read
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json")) as f:
+            index = json.load(f)
+        self.files = index["columns"]
+        self.columns = list(self.files)
+        self.pieces = index["pieces"]
+        self.offsets = np.asarray(index["offsets"])
+        self.piece_index = {name: i for i, name in enumerate(self.pieces)}
+        self._arrays = {}
+
+    def column(self, column): # the whole column, all pieces back to back
+        if column not in self._arrays:
+            self._arrays[column] = np.load(os.path.join(self.path, self.files[column]), mmap_mode="r")
+        return self._arrays[column]
+
+    def piece(self, name, columns=None):
+        # {column: array view} for one piece in store order, only the columns asked for if given. like the JSON formats, columns
+        # that aren't stored are left out rather than raising
+        i = self.piece_index[name]
+        start, end = self.offsets[i], self.offsets[i + 1]
+        return {column: self.column(column)[start:end] for column in self.columns if columns is None or column in columns}
+
+
+def feature_writer(path): # a ColumnStoreWriter if path is a directory name (no extension), otherwise a PieceWriter for .jsonl
+    return PieceWriter(path) if os.path.splitext(path)[1] else ColumnStoreWriter(path)
+
+
+def iter_pieces(path, columns=None):
+    # yields (piece name, {column: values}), one piece at a time for .jsonl and column stores. with columns, only those columns are
+    # kept (still in the stored order), and for a column store only those are read
+    if os.path.isdir(path):
+        store = ColumnStore(path)
+        for name in store.pieces:
+            yield name, {column: values.tolist() for column, values in store.piece(name, columns).items()}
+        return
+
+    for name, features in _iter_json_pieces(path):
+        if columns is not None:
+            features = {column: values for column, values in features.items() if column in columns}
+        yield name, features
+
+
+def _iter_json_pieces(path):
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            for line in f:
+                entry = json.loads(line)
+                yield entry["piece"], entry["features"]
+    else:
+        with open(path) as f:
+            yield from json.load(f).items()
+
+
+def load_pieces(path, columns=None):
+    return dict(iter_pieces(path, columns))
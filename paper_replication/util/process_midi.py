@@ -1,23 +1,33 @@
-""" For processing the ASAP Dataset. """
+""" For processing the ASAP Dataset. Run from paper_replication with python -m util.process_midi [-w WORKERS] [-i]. """
 
 import os
 import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
-import pandas
 import mido
 
+from util.alignment import warp_onsets, match_onsets
+from util.midi_events import decode_midi, note_lengths
+from util.note_table import write_note_table
+from util.atomic import write_atomic
+from util import asap_index
+
 ASAP_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-master"
 PROCESSED_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed"
+MANIFEST_PATH = os.path.join(PROCESSED_PATH, "manifest.json")
+
+PIPELINE_VERSION = 2 # bump whenever a change here changes the processed files, so incremental runs redo everything
 
-METADATA = pandas.read_csv(os.path.join(ASAP_PATH, "metadata.csv"))
-ASAP_ANNOTATIONS = json.load(open(os.path.join(ASAP_PATH, "asap_annotations.json")))
 
 
 def parse_midi(path=None, id=None): # parses midi for one performance
     if path:
 
-        if not ASAP_ANNOTATIONS[path]["score_and_performance_aligned"]:
+        if not asap_index.is_aligned(path):
             
             return None, None, None, None
 
@@ -43,8 +53,7 @@ def parse_midi(path=None, id=None): # parses midi for one performance
 
         # finding the performance specified by path and get performance_beats which is a list of all timestamps of the beats in
         # the performance, and score_beats is the same for the score
-        perf_beats = ASAP_ANNOTATIONS[path]["performance_beats"]
-        score_beats = ASAP_ANNOTATIONS[path]["midi_score_beats"]
+        perf_beats, score_beats = asap_index.beats(path)
 
         shifted_notes = {}
         score_notes = {}
@@ -52,116 +61,48 @@ def parse_midi(path=None, id=None): # parses midi for one performance
         all_timed_score_vels = []
         all_timed_score_lengths = []
 
-        offset = 0
-        playing_note_times = {}
-        
-        for msg in perf_mf: # for each command in the midi file of the performance
-
-            offset += msg.time
-            for key in playing_note_times:
-                playing_note_times[key] += msg.time
-            
-            if msg.type == "note_on" or msg.type == "note_off":
-                if msg.type == "note_on" and msg.velocity > 0:
-                    if msg.note in playing_note_times:
-                        continue # DOUBLE NOTE???
-                    for i, b_off in enumerate(perf_beats):
-                        if b_off > offset:
-                            a = 0 if i == 0 else perf_beats[i-1]
-                            b = b_off
-                            beat_index = i
-                            break
-                    else:
-                        a = perf_beats[-1]
-                        b = perf_beats[-1] + (perf_beats[-1]-perf_beats[-2])
-                        beat_index = len(perf_beats)
-                        if offset > b:
-                            b = offset + .01
-                            #print(f"Note past last bar in {path}!")
-
-                    
-                    a_prime = 0 if beat_index == 0 else score_beats[beat_index-1]
-                    b_prime = score_beats[beat_index-1] + (score_beats[beat_index-1] - score_beats[beat_index-2]) if beat_index == len(perf_beats) else score_beats[beat_index]
-
-                    new_offset = (b_prime - a_prime) / (b - a) * (offset - a) + a_prime
-                    playing_note_times[msg.note] = 0
-                    
-                    if msg.note in shifted_notes:
-                        shifted_notes[msg.note].append([new_offset, False, msg.velocity, 0])
-                    else:
-                        shifted_notes[msg.note] = [[new_offset, False, msg.velocity, 0]]
-                else:
-                    if msg.note not in playing_note_times:
-                        continue # DOUBLE END_NOTE?
-                    shifted_notes[msg.note][-1][3] = playing_note_times[msg.note]
-                    del playing_note_times[msg.note]
-
-
-        
-        offset = 0
-        playing_note_times = {}
-        playing_currently = 0
-
-        
-        for msg in score_mf: # for each command in the score file
-            offset += msg.time
-            for key in playing_note_times:
-                playing_note_times[key] += msg.time
-            
-            if msg.type == "note_on" or msg.type == "note_off":
-                if msg.type == "note_on" and msg.velocity > 0:
-                    if msg.note in playing_note_times:
-                        continue # DOUBLE NOTE???
-                    playing_currently += 1
-                    if msg.note in score_notes:
-                        if score_notes[msg.note][-1][0] == offset: # If there is a 0-length at this location already, reset it
-                            score_notes[msg.note][-1] = [offset, False, 0, score_notes[msg.note][-1][3], 0, -1, playing_currently]
-                            playing_note_times[msg.note] = 0
-                            continue
-                        score_notes[msg.note].append([offset, False, 0, len(all_timed_score_vels), 0, -1, playing_currently])
-                    else:
-                        score_notes[msg.note] = [[offset, False, 0, len(all_timed_score_vels), 0, -1, playing_currently]]
-                    all_timed_score_vels.append(0)
-                    all_timed_score_lengths.append(0)
-
-                    playing_note_times[msg.note] = 0
-                else:
-
-                    if msg.note not in playing_note_times:
-                        continue # DOUBLE END_NOTE?
-                        
-                    playing_currently -= 1
-                    score_notes[msg.note][-1][5] = playing_note_times[msg.note]
-
-                    del playing_note_times[msg.note]
+        # performance notes, shifted onto score time in one pass
+        perf_notes = decode_midi(perf_mf)
+        new_offsets = warp_onsets(perf_notes["onset"], perf_beats, score_beats)
+
+        for pitch, new_offset, velocity, length in zip(perf_notes["pitch"].tolist(), new_offsets.tolist(), perf_notes["velocity"].tolist(), note_lengths(perf_notes).tolist()):
+            if pitch in shifted_notes:
+                shifted_notes[pitch].append([new_offset, False, velocity, length])
+            else:
+                shifted_notes[pitch] = [[new_offset, False, velocity, length]]
+
+
+        score_notes_decoded = decode_midi(score_mf)
+        score_lengths = note_lengths(score_notes_decoded, unfinished=-1).tolist()
+
+        for onset, pitch, length, playing_currently in zip(score_notes_decoded["onset"].tolist(), score_notes_decoded["pitch"].tolist(), score_lengths, score_notes_decoded["voices"].tolist()):
+            if pitch in score_notes:
+                if score_notes[pitch][-1][0] == onset: # If there is a 0-length at this location already, reset it
+                    score_notes[pitch][-1] = [onset, False, 0, score_notes[pitch][-1][3], 0, length, playing_currently]
+                    continue
+                score_notes[pitch].append([onset, False, 0, len(all_timed_score_vels), 0, length, playing_currently])
+            else:
+                score_notes[pitch] = [[onset, False, 0, len(all_timed_score_vels), 0, length, playing_currently]]
+            all_timed_score_vels.append(0)
+            all_timed_score_lengths.append(0)
         
         
-        give_up = 0 # NEVER BACK DOWN NEVER WHAT?????
-
         for pitch in score_notes:
             if pitch not in shifted_notes:
                 #print(f"MISSING PITCH {pitch}: never played")
                 continue
-            shifted_offsets = np.asarray(shifted_notes[pitch])[:,0]
-
-            for i in range(len(score_notes[pitch])):
-                offset = score_notes[pitch][i][0]
-                idx_list = (np.abs(shifted_offsets - offset)).argsort()
-                for idx in idx_list:
-                    if abs(shifted_notes[pitch][idx][0] - offset) > .5:
-                        #print(offset, shifted_notes[pitch][idx][0])
-                        break
-                    if shifted_notes[pitch][idx][3] == 0:
-                        print("SKIPPING 0 LEN")
-                        continue
-                    else: 
-                        shifted_notes[pitch][idx][1] = True
-                        score_notes[pitch][i][1] = True # Has been matched <- True
-                        score_notes[pitch][i][2] = shifted_notes[pitch][idx][2] # Velocity
-                        score_notes[pitch][i][4] = shifted_notes[pitch][idx][3] # Note length of player
-                        all_timed_score_vels[score_notes[pitch][i][3]] = shifted_notes[pitch][idx][2] # Velocity in flatlist
-                        all_timed_score_lengths[score_notes[pitch][i][3]] = shifted_notes[pitch][idx][3] # Length in flatlist
-                        break
+            shifted = np.asarray(shifted_notes[pitch], dtype=float)
+            matches = match_onsets([note[0] for note in score_notes[pitch]], shifted[:,0], shifted[:,3])
+
+            for i, idx in enumerate(matches.tolist()):
+                if idx == -1:
+                    continue
+                shifted_notes[pitch][idx][1] = True
+                score_notes[pitch][i][1] = True # Has been matched <- True
+                score_notes[pitch][i][2] = shifted_notes[pitch][idx][2] # Velocity
+                score_notes[pitch][i][4] = shifted_notes[pitch][idx][3] # Note length of player
+                all_timed_score_vels[score_notes[pitch][i][3]] = shifted_notes[pitch][idx][2] # Velocity in flatlist
+                all_timed_score_lengths[score_notes[pitch][i][3]] = shifted_notes[pitch][idx][3] # Length in flatlist
 
         for i in score_notes:
             for ind, j in enumerate(score_notes[i]):
@@ -191,23 +132,128 @@ def parse_midi(path=None, id=None): # parses midi for one performance
         return shifted_notes, score_notes, all_notes_and_data, missing
 
 
-# making and populating a text file for each piece with Midi_number, time_when_happens, matched?, velocity, link_to_flatlist(old),
-# note_length_played, note_length_original, got_stop_signal? all seperated by tabs 
-for i, row in METADATA.iterrows(): 
-    print(f"Processing {row['midi_performance']}:  ", end="")
-    processed_path = os.path.join(PROCESSED_PATH, row["midi_performance"])[:-4] + ".txt"
+def processed_path_of(perf_name):
+    return os.path.join(PROCESSED_PATH, perf_name)[:-4] + ".npz"
 
-    shifted, score, all_notes_and_data, missing = parse_midi(row['midi_performance'])
 
-    if not all_notes_and_data:
-        print(f"Score & performance not aligned! Skipped.")
-        continue
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def input_hash(perf_name, score_hashes=None): # hash of everything parse_midi uses for this performance, plus PIPELINE_VERSION
+    perf_path = os.path.join(ASAP_PATH, perf_name)
+    score_path = os.path.join(os.path.dirname(perf_path), "midi_score.mid")
 
-    print(f"{missing} missing.")
+    if score_hashes is None:
+        score_hashes = {}
+    if score_path not in score_hashes: # lots of performances share a score
+        score_hashes[score_path] = file_hash(score_path)
 
-    os.makedirs(os.path.dirname(processed_path), exist_ok=True)
-    with open(processed_path, "w") as f:
-        f.write("\n".join("\t".join(str(x) for x in a) for a in all_notes_and_data))
+    h = hashlib.sha256()
+    h.update(str(PIPELINE_VERSION).encode())
+    h.update(file_hash(perf_path).encode())
+    h.update(score_hashes[score_path].encode())
+    perf_beats, score_beats = asap_index.beats(perf_name)
+    h.update(str(asap_index.is_aligned(perf_name)).encode())
+    h.update(np.asarray(perf_beats, dtype=np.float64).tobytes())
+    h.update(np.asarray(score_beats, dtype=np.float64).tobytes())
+    return h.hexdigest()
 
 
-#parse_midi("Chopin/Scherzos/39/Bult-ItoS05M.mid")
\ No newline at end of file
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+# making and populating a note table for each piece with Midi_number, time_when_happens, matched?, velocity, link_to_flatlist(old),
+# note_length_played, note_length_original, got_stop_signal? as columns (see util.note_table)
+def process_performance(perf_name): # parses and saves one performance, returns (matched, missing, seconds taken), or None if skipped
+    start = time.perf_counter()
+
+    shifted, score, all_notes_and_data, missing = parse_midi(perf_name)
+
+    if not all_notes_and_data:
+        if os.path.exists(processed_path_of(perf_name)): # it used to be aligned, the old output is stale now
+            os.remove(processed_path_of(perf_name))
+        return None
+
+    write_note_table(processed_path_of(perf_name), all_notes_and_data)
+
+    return len(all_notes_and_data) - missing, missing, time.perf_counter() - start
+
+
+def preprocess_all(workers=1, incremental=False):
+    # processes every performance in the metadata, spread over workers processes. with incremental, performances whose inputs hash
+    # the same as in the manifest (and whose output is still there) aren't redone
+    perf_names = list(asap_index.metadata()["midi_performance"])
+    start = time.perf_counter()
+
+    old_manifest = load_manifest() if incremental else {}
+    score_hashes = {}
+    hashes = {perf_name: input_hash(perf_name, score_hashes) for perf_name in perf_names}
+
+    def up_to_date(perf_name):
+        entry = old_manifest.get(perf_name)
+        if entry is None or entry["hash"] != hashes[perf_name]:
+            return False
+        return not entry["aligned"] or os.path.exists(processed_path_of(perf_name))
+
+    unchanged, to_build = [], []
+    for perf_name in perf_names:
+        (unchanged if up_to_date(perf_name) else to_build).append(perf_name)
+
+    manifest = {perf_name: old_manifest[perf_name] for perf_name in unchanged}
+    rebuilt, not_aligned, total_missing = [], [], 0
+
+    def report(done, perf_name, result):
+        nonlocal total_missing
+        manifest[perf_name] = {"hash": hashes[perf_name], "aligned": result is not None}
+        if result is None:
+            not_aligned.append(perf_name)
+            print(f"[{done}/{len(to_build)}] {perf_name}: Score & performance not aligned! Skipped.")
+            return
+        matched, missing, seconds = result
+        rebuilt.append(perf_name)
+        total_missing += missing
+        print(f"[{done}/{len(to_build)}] {perf_name}: {matched} matched, {missing} missing. ({seconds:.2f}s)")
+
+    if workers == 1:
+        for done, perf_name in enumerate(to_build, 1):
+            report(done, perf_name, process_performance(perf_name))
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(process_performance, perf_name): perf_name for perf_name in to_build}
+            for done, future in enumerate(as_completed(futures), 1):
+                report(done, futures[future], future.result())
+
+    # performances that left the metadata since the last run
+    removed = [perf_name for perf_name in old_manifest if perf_name not in hashes]
+    for perf_name in removed:
+        if os.path.exists(processed_path_of(perf_name)):
+            os.remove(processed_path_of(perf_name))
+
+    write_atomic(MANIFEST_PATH, json.dumps(manifest, indent=1, sort_keys=True))
+
+    print(f"Rebuilt {len(rebuilt)}, skipped {len(unchanged)} unchanged, {len(not_aligned)} not aligned, removed {len(removed)}. {total_missing} missing in total. Took {time.perf_counter() - start:.1f}s.")
+    if incremental:
+        for title, perf_list in [("Rebuilt", rebuilt), ("Not aligned", not_aligned), ("Removed", removed)]:
+            if perf_list:
+                print(f"{title}:")
+                for perf_name in perf_list:
+                    print(f"    {perf_name}")
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("-w", "--workers", help="Number of processes to parse performances with.", type=int, default=os.cpu_count())
+    argParser.add_argument("-i", "--incremental", help="Only redo performances whose inputs changed since the last run.", action=argparse.BooleanOptionalAction)
+    args = argParser.parse_args()
+
+    preprocess_all(args.workers, args.incremental)
+
+
+#parse_midi("Chopin/Scherzos/39/Bult-ItoS05M.mid")
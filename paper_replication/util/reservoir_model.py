@@ -11,10 +11,12 @@ from functools import wraps
 
 from reservoirpy.nodes import Reservoir, Ridge, ESN # type: ignore
 
+from util.activations import get_activation
 
-def create_model(input_scaling, N, sr, lr, ridge, seed, rc_connectivity=0.1, input_connectivity=0.1, activation_func='relu'):
-        
-    reservoir = Reservoir(
+
+def create_reservoir(input_scaling, N, sr, lr, seed, rc_connectivity=0.1, input_connectivity=0.1, activation_func='relu'):
+    # the same seed and parameters always give the same reservoir, util.state_cache relies on this
+    return Reservoir(
             units=N,
             sr=sr,
             lr=lr,
@@ -22,9 +24,15 @@ def create_model(input_scaling, N, sr, lr, ridge, seed, rc_connectivity=0.1, inp
             seed=seed,
             rc_connectivity=rc_connectivity,
             input_connectivity=input_connectivity,
-            activation=activation_func
+            activation=get_activation(activation_func) # a name from util.activations, or a function
         )
 
+
+def create_model(input_scaling, N, sr, lr, ridge, seed, rc_connectivity=0.1, input_connectivity=0.1, activation_func='relu', readout=None):
+    # readout is an already solved (Wout, bias), e.g. from util.state_cache, the model then doesn't need fitting
+        
+    reservoir = create_reservoir(input_scaling, N, sr, lr, seed, rc_connectivity, input_connectivity, activation_func)
+
     print('units: ', N)
     print('sr: ', sr)
     print('lr: ', lr)
@@ -37,7 +45,10 @@ def create_model(input_scaling, N, sr, lr, ridge, seed, rc_connectivity=0.1, inp
 
     #reservoirs = [Reservoir(100, lr=lr, sr=sr) for i in num_inputs]
     #print(f"{len(reservoirs)} Res[]s")
-    ridge = Ridge(ridge=ridge)
+    if readout is None:
+        ridge = Ridge(ridge=ridge)
+    else:
+        ridge = Ridge(ridge=ridge, Wout=readout[0], bias=readout[1])
 
     #esn = reservoir >> ridge
     esn = ESN(reservoir=reservoir, readout=ridge, workers=-1, feedback=False)
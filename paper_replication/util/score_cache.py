@@ -0,0 +1,103 @@
+""" For caching the score-level analysis (key from music21, tempo from the MIDI score) that many performances share.
+
+Entries are keyed by score directory and only used while the hash of xml_score.musicxml and midi_score.mid still matches, and
+are kept across runs in SCORE_CACHE_PATH. """
+
+import os
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import mido
+import music21
+
+PROCESSED_PATH = "/stash/tlab/theom_intern/midi_data/asap-dataset-processed"
+SCORE_CACHE_PATH = os.path.join(PROCESSED_PATH, "score_cache.json")
+
+CACHE_VERSION = 1 # bump when analyze_score changes what it stores
+
+_cache = None
+_dirty = False
+
+
+def _load_cache():
+    global _cache
+    if _cache is None:
+        try:
+            with open(SCORE_CACHE_PATH) as f:
+                _cache = json.load(f)
+            if _cache.get("version") != CACHE_VERSION:
+                _cache = None
+        except FileNotFoundError:
+            pass
+        if _cache is None:
+            _cache = {"version": CACHE_VERSION, "scores": {}}
+    return _cache["scores"]
+
+
+def score_hash(score_dir):
+    h = hashlib.sha256()
+    for filename in ["xml_score.musicxml", "midi_score.mid"]:
+        with open(os.path.join(score_dir, filename), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def analyze_score(score_dir): # the slow part, parses the score with music21
+    key_sig = music21.converter.parse(os.path.join(score_dir, "xml_score.musicxml")).analyze('key')
+
+    for elem in mido.MidiFile(os.path.join(score_dir, "midi_score.mid")):
+        if elem.type == 'set_tempo':
+            tempo = 60000000/elem.tempo
+            break
+    else:
+        tempo = None
+
+    return {"sharps": key_sig.sharps, "key": str(key_sig), "tempo": tempo}
+
+
+def score_analysis(score_dir): # {"sharps", "key", "tempo"} for the score in score_dir, tempo is None if the MIDI score has none
+    global _dirty
+    scores = _load_cache()
+    current_hash = score_hash(score_dir)
+
+    entry = scores.get(score_dir)
+    if entry is None or entry["hash"] != current_hash:
+        entry = {"hash": current_hash, **analyze_score(score_dir)}
+        scores[score_dir] = entry
+        _dirty = True
+
+    return {k: v for k, v in entry.items() if k != "hash"}
+
+
+def warm_score_cache(score_dirs, workers=1):
+    # analyzes every score in score_dirs that isn't cached yet, spread over workers processes, and saves the cache. worker processes
+    # started afterwards then only read it
+    global _dirty
+    scores = _load_cache()
+    hashes = {score_dir: score_hash(score_dir) for score_dir in dict.fromkeys(score_dirs)}
+    stale = [score_dir for score_dir, h in hashes.items() if score_dir not in scores or scores[score_dir]["hash"] != h]
+
+    if workers == 1 or len(stale) < 2:
+        results = list(map(analyze_score, stale))
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(stale))) as pool:
+            results = list(pool.map(analyze_score, stale))
+
+    for score_dir, analysis in zip(stale, results):
+        scores[score_dir] = {"hash": hashes[score_dir], **analysis}
+        _dirty = True
+
+    save_score_cache()
+
+
+def save_score_cache(): # only writes if something was added
+    global _dirty
+    if not _dirty:
+        return
+    os.makedirs(os.path.dirname(SCORE_CACHE_PATH), exist_ok=True)
+    tmp_path = f"{SCORE_CACHE_PATH}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(_cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, SCORE_CACHE_PATH)
+    _dirty = False
@@ -0,0 +1,298 @@
+""" A hyperparameter search that hands trials out from one queue to a pool of workers, so every worker takes the next trial as
+soon as it's done with one and fast and slow machines finish together.
+
+A worker is anything with start(), run(params) -> the trial's returned dict, and close(). LocalWorker runs trials in a local process,
+CommandWorker in a process started from a command it talks to over stdin/stdout (python -m util.search --worker), and SSHWorker
+is a CommandWorker started over ssh on another machine. CommandWorker with the default command runs the same protocol locally,
+as a stand-in for remote workers. Every worker loads the trial data once (see util.trials) and keeps it between trials.
+
+Results are saved like reservoirpy's research saves them, in {exp}/results, so plot_hyperopt_report reads them the same way. The
+trials are sampled at random from the config's hp_space, like hp_method "random". Run a worker by hand with
+python -m util.search --worker from paper_replication. """
+
+import os
+import sys
+import json
+import time
+import glob
+import queue
+import importlib
+import shlex
+import argparse
+import threading
+import traceback
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from util.trials import load_trial_data, score_trial
+
+TRIAL_LOSSES = 2 # a trial that this many workers were lost on counts as failed instead of going back in the queue again
+SSH_CONNECT_TIMEOUT = 10 # seconds, see ssh_command
+
+
+class WorkerLost(Exception): # a worker stopped working, the trial it had goes back in the queue (see TRIAL_LOSSES)
+    pass
+
+
+def sample_params(hp_space, rng): # one set of parameters from a reservoirpy hp_space, see research's config
+    params = {}
+    for name, (kind, *args) in hp_space.items():
+        if kind == "choice":
+            params[name] = args[rng.integers(len(args))]
+        elif kind == "randint":
+            params[name] = int(rng.integers(*args))
+        elif kind == "uniform":
+            params[name] = float(rng.uniform(*args))
+        elif kind == "loguniform":
+            params[name] = float(np.exp(rng.uniform(np.log(args[0]), np.log(args[1]))))
+        else:
+            raise ValueError(f"Unsupported search space {kind} for {name}, expected choice, randint, uniform or loguniform")
+    return params
+
+
+def sample_trials(config): # the hp_max_evals parameter sets of a search, the same ones for the same config seed
+    rng = np.random.default_rng(config.get("seed"))
+    return [sample_params(config["hp_space"], rng) for _ in range(config["hp_max_evals"])]
+
+
+def save_result(report_path, params, returned): # like reservoirpy's research, {loss}_hyperopt_results_{n}call.json
+    save_file = os.path.join(report_path, f"{returned['loss']:.7f}_hyperopt_results")
+    save_file = f"{save_file}_{len(glob.glob(f'{save_file}*')) + 1}call.json"
+    with open(save_file, "w+") as f:
+        json.dump({"returned_dict": returned, "current_params": params}, f, indent=2)
+
+
+def trial_setup(config, data_path=None, metadata_path=None, scorer=None):
+    # what a worker needs before it can run trials. scorer is "module.function" for a function(config, params) -> returned dict
+    # to use instead of util.trials.score_trial on the data, for trying the workers out without the data (see check_search)
+    return {"config": config, "data_path": data_path, "metadata_path": metadata_path, "scorer": scorer}
+
+
+def ssh_command(host, command, connect_timeout=SSH_CONNECT_TIMEOUT):
+    # ssh that fails instead of asking for a password, gives up on a host that doesn't answer within connect_timeout seconds, and
+    # notices when a connection goes quiet (ServerAlive, after about a minute)
+    return ["ssh", "-o", "BatchMode=yes", "-o", f"ConnectTimeout={connect_timeout}", "-o", "ServerAliveInterval=15", "-o", "ServerAliveCountMax=4", host, command]
+
+
+_worker_state = {} # in a worker process, the setup's config and how to score a trial
+
+
+def _init_worker(setup):
+    _worker_state["config"] = setup["config"]
+    if setup.get("scorer"):
+        module, function = setup["scorer"].rsplit(".", 1)
+        _worker_state["score"] = getattr(importlib.import_module(module), function)
+    else:
+        data = load_trial_data(setup["data_path"], setup["metadata_path"])
+        _worker_state["score"] = lambda config, params: score_trial(data, config, **params)
+
+
+def _run_trial(params): # the worker's scorer (score_trial with its data), timed like research times it
+    start = time.time()
+    returned = _worker_state["score"](_worker_state["config"], params)
+    returned.update(status="ok", start_time=start, duration=time.time() - start)
+    return returned
+
+
+class LocalWorker:
+    # runs trials in one local process, which loads the trial data once
+    def __init__(self, setup):
+        self.setup = setup
+        self.name = "local"
+        self.pool = None
+
+    def start(self):
+        self.pool = ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(self.setup,))
+        self.pool.submit(int) # starts the process, and with it loading the data
+
+    def run(self, params):
+        try:
+            return self.pool.submit(_run_trial, params).result()
+        except BrokenProcessPool as e:
+            raise WorkerLost(f"{self.name} stopped") from e
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+
+class CommandWorker:
+    # runs trials in a process started from command, which should end up running python -m util.search --worker. it gets the
+    # setup and then one set of parameters per line on stdin, and answers each with a line of JSON on stdout. a worker that
+    # doesn't answer within the config's trial_timeout seconds (counting from when the trial was sent, so the first one includes
+    # loading the data) is stopped and lost
+    def __init__(self, setup, command=None, name="stand-in"):
+        self.setup = setup
+        self.command = command or [sys.executable, "-m", "util.search", "--worker"]
+        self.name = name
+        self.timeout = setup["config"].get("trial_timeout")
+        self.process = None
+        self.lines = None
+
+    def start(self):
+        try:
+            self.process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1,
+                                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        except OSError as e:
+            raise WorkerLost(f"{self.name} couldn't start") from e
+        self._send(self.setup)
+
+    def _send(self, message):
+        try:
+            self.process.stdin.write(json.dumps(message) + "\n")
+            self.process.stdin.flush()
+        except (BrokenPipeError, OSError) as e:
+            raise WorkerLost(f"{self.name} stopped") from e
+
+    def _read(self): # stdout line by line into self.lines, then "" once it's closed
+        for line in self.process.stdout:
+            self.lines.put(line)
+        self.lines.put("")
+
+    def _readline(self, deadline):
+        if self.lines is None: # started from the first run, after search has started all the processes
+            self.lines = queue.Queue()
+            threading.Thread(target=self._read, daemon=True).start()
+        try:
+            return self.lines.get(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        except queue.Empty:
+            self.process.kill()
+            raise WorkerLost(f"{self.name} didn't answer within {self.timeout}s") from None
+
+    def run(self, params):
+        self._send(params)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        answer = None
+        while answer is None: # skipping anything else on stdout, like what a login shell prints
+            line = self._readline(deadline)
+            if not line:
+                raise WorkerLost(f"{self.name} stopped with exit code {self.process.wait()}")
+            try:
+                answer = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(answer, dict):
+                answer = None
+        if "error" in answer:
+            raise RuntimeError(f"{self.name}: {answer['error']}")
+        return answer["returned"]
+
+    def close(self):
+        if self.process is not None and self.process.poll() is None:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=SSH_CONNECT_TIMEOUT)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+
+
+class SSHWorker(CommandWorker):
+    # a CommandWorker on another machine. setup_command runs first in a login shell there, to activate the right environment
+    def __init__(self, setup, host, directory=None, setup_command=None, python="python3"):
+        directory = directory or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        remote = " && ".join(([setup_command] if setup_command else []) + [f"cd {shlex.quote(directory)}", f"{python} -m util.search --worker"])
+        super().__init__(setup, ssh_command(host, f"bash -lic {shlex.quote(remote)}"), name=host)
+
+
+def search(config, workers, report_path=None, progress=None):
+    # runs all of sample_trials(config) on workers, each taking the next trial from one queue. the trial a worker had when it was
+    # lost goes back in the queue for the others, unless TRIAL_LOSSES workers were lost on it (it likely took them down, running
+    # out of memory say), then it counts as failed. returns (best params, best returned dict), results are saved in report_path
+    # ({exp}/results by default). progress(done, total) is called after every trial
+    report_path = report_path or os.path.join(config["exp"], "results")
+    os.makedirs(report_path, exist_ok=True)
+
+    trials = sample_trials(config)
+    pending = queue.Queue()
+    for trial in enumerate(trials):
+        pending.put(trial)
+
+    lock = threading.Lock()
+    finished = threading.Event()
+    outcomes = {} # trial index -> returned dict
+    losses = {} # trial index -> how many workers were lost on it
+
+    def serve(worker):
+        try:
+            while not finished.is_set():
+                try:
+                    i, params = pending.get(timeout=1)
+                except queue.Empty:
+                    continue
+
+                lost = False
+                try:
+                    returned = worker.run(params)
+                except WorkerLost as e:
+                    lost = True
+                    losses[i] = losses.get(i, 0) + 1 # only this worker has trial i now
+                    if losses[i] < TRIAL_LOSSES:
+                        pending.put((i, params))
+                        print(f"{e}, its trial goes to the other workers", file=sys.stderr)
+                        return
+                    print(f"{e}, that's {losses[i]} workers lost on trial {params}, it counts as failed", file=sys.stderr)
+                    returned = {"status": "fail", "start_time": time.time(), "error": f"{losses[i]} workers lost on it, the last: {e}"}
+                except Exception as e:
+                    returned = {"status": "fail", "start_time": time.time(), "error": str(e)}
+
+                with lock:
+                    outcomes[i] = returned
+                    if returned["status"] == "ok":
+                        save_result(report_path, params, returned)
+                    if progress:
+                        progress(len(outcomes), len(trials))
+                    if len(outcomes) == len(trials):
+                        finished.set()
+                if lost:
+                    return
+        finally:
+            worker.close()
+
+    started = []
+    for worker in workers: # all the processes are started before any of the threads, forking while they run can hang
+        try:
+            worker.start()
+            started.append(worker)
+        except WorkerLost as e:
+            print(e, file=sys.stderr)
+
+    threads = [threading.Thread(target=serve, args=(worker,), daemon=True) for worker in started]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if len(outcomes) < len(trials):
+        print(f"All workers were lost with {len(trials) - len(outcomes)} trials left", file=sys.stderr)
+
+    done = [i for i, returned in outcomes.items() if returned["status"] == "ok"]
+    if not done:
+        return None, None
+    best = min(done, key=lambda i: outcomes[i]["loss"])
+    return trials[best], outcomes[best]
+
+
+def serve_trials():
+    # the worker side of CommandWorker. anything printed while running trials goes to stderr, stdout is only for the answers
+    answers, sys.stdout = sys.stdout, sys.stderr
+
+    _init_worker(json.loads(sys.stdin.readline()))
+    for line in sys.stdin:
+        try:
+            answer = {"returned": _run_trial(json.loads(line))}
+        except Exception:
+            answer = {"error": traceback.format_exc()}
+        answers.write(json.dumps(answer) + "\n")
+        answers.flush()
+
+
+if __name__ == "__main__":
+    argParser = argparse.ArgumentParser()
+    argParser.add_argument("--worker", help="Run trials sent on stdin, see CommandWorker.", action=argparse.BooleanOptionalAction)
+    args = argParser.parse_args()
+
+    if args.worker:
+        serve_trials()
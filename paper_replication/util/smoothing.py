@@ -0,0 +1,42 @@
+""" For smoothing a sequence with a centred window, for the Macro/Micro split in extract_features. """
+
+import numpy as np
+
+
+def _weights(kernel, n, sigma=None, tau=None): # the 2n+1 weights of a centred kernel, sigma and tau default to n / 2
+    if n < 0:
+        raise ValueError(f"Window half-width can't be negative, got {n}")
+    if n == 0 and kernel in ("box", "gaussian", "exponential"): # just the value itself, like moving_average(a, 0)
+        return np.ones(1)
+    k = np.arange(-n, n + 1)
+    if kernel == "box":
+        return np.ones(2*n + 1)
+    if kernel == "gaussian":
+        sigma = n / 2 if sigma is None else sigma
+        if sigma <= 0:
+            raise ValueError(f"sigma must be positive, got {sigma}")
+        return np.exp(-.5 * (k / sigma) ** 2)
+    if kernel == "exponential":
+        tau = n / 2 if tau is None else tau
+        if tau <= 0:
+            raise ValueError(f"tau must be positive, got {tau}")
+        return np.exp(-np.abs(k) / tau)
+    raise ValueError(f"Unknown kernel {kernel}, expected box, gaussian or exponential")
+
+
+def smooth(a, n, kernel="box", **params):
+    # weighted average over the n values on each side. near the edges the window is cut off and only the weights inside it count,
+    # so box gives exactly the old moving_average
+    a = np.asarray(a, dtype=float)
+    if len(a) == 0:
+        return a
+
+    weights = _weights(kernel, n, **params)
+    return np.convolve(a, weights)[n:n + len(a)] / np.convolve(np.ones(len(a)), weights)[n:n + len(a)]
+
+
+def smooth_passes(a, passes): # applies smooth for each (kernel, n) or (kernel, n, {params}) in passes, in order
+    for smoothing in passes:
+        kernel, n, params = (smoothing + ({},))[:3]
+        a = smooth(a, n, kernel, **params)
+    return a
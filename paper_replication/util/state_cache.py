@@ -0,0 +1,116 @@
+""" For caching what the ridge readout needs from a reservoir's run over the training data, so trials that only differ in ridge
+don't run the reservoir again, and for solving the readout for many ridge values at once.
+
+The ridge readout only sees the training data through XᵀX and XᵀY, where X is the reservoir states with a column of ones in front
+(for the bias) and Y the targets. Those are kept per reservoir (its parameters) and training set (a hash of the arrays), in
+memory and in STATE_CACHE_PATH, and solve_readout gets the readout from them the same way reservoirpy's Ridge does. RidgeSolver
+does the same for a whole list of ridge values from a single eigendecomposition. """
+
+import os
+import json
+import hashlib
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+
+from util.reservoir_model import create_reservoir
+
+STATE_CACHE_PATH = "/stash/tlab/theom_intern/reservoir_states"
+
+CACHE_VERSION = 1 # bump when what's accumulated changes
+MEMORY_ENTRIES = 8 # how many accumulators to keep in memory, each is about (N+1)² floats
+
+RIDGES = np.logspace(-3, 1, 25) # the ridge values a tuning trial scores when it isn't given one
+
+_accumulators = OrderedDict() # key -> (xtx, xty), the most recently used last
+
+
+def dataset_fingerprint(inputs, targets):
+    # a hash of the training pieces, their shapes, types and values. the pieces are looked at one at a time, so they can be made
+    # as they're iterated over (like RepeatedPieces' values)
+    h = hashlib.sha256()
+    for piece in itertools.chain(inputs, targets):
+        piece = np.ascontiguousarray(piece)
+        h.update(f"{piece.shape} {piece.dtype}".encode())
+        h.update(piece.data)
+    return h.hexdigest()
+
+
+def reservoir_key(reservoir_params, fingerprint):
+    # reservoir_params are create_reservoir's keyword arguments. a function given as the activation counts by its name
+    params = dict(reservoir_params)
+    activation = params.get("activation_func", "relu")
+    if callable(activation):
+        params["activation_func"] = f"{activation.__module__}.{activation.__qualname__}"
+    return hashlib.sha256(json.dumps([CACHE_VERSION, params, fingerprint], sort_keys=True).encode()).hexdigest()
+
+
+def run_states(reservoir_params, pieces): # {piece: reservoir states} for {piece: inputs}, each run from a reset state
+    reservoir = create_reservoir(**reservoir_params)
+    return {name: reservoir.run(np.asarray(x), reset=True) for name, x in pieces.items()}
+
+
+def harvest(reservoir_params, inputs, targets):
+    # (XᵀX, XᵀY) for the reservoir made by create_reservoir(**reservoir_params), run over each of the input pieces from a reset
+    # state
+    reservoir = create_reservoir(**reservoir_params)
+    xtx, xty = None, None
+    for x, y in zip(inputs, targets):
+        states = reservoir.run(np.asarray(x), reset=True)
+        states = np.hstack([np.ones((len(states), 1)), states]) # the bias column first, like reservoirpy's Ridge
+        y = np.asarray(y, dtype=float).reshape(len(states), -1)
+        if xtx is None:
+            xtx, xty = states.T @ states, states.T @ y
+        else:
+            xtx += states.T @ states
+            xty += states.T @ y
+    return xtx, xty
+
+
+def readout_accumulators(reservoir_params, inputs, targets, fingerprint=None):
+    # harvest, but only run the reservoir if this reservoir and training set aren't cached yet. fingerprint is
+    # dataset_fingerprint(inputs, targets), if it's already known
+    key = reservoir_key(reservoir_params, fingerprint or dataset_fingerprint(inputs, targets))
+    if key in _accumulators:
+        _accumulators.move_to_end(key)
+        return _accumulators[key]
+
+    path = os.path.join(STATE_CACHE_PATH, f"{key}.npz")
+    try:
+        with np.load(path) as cached:
+            entry = cached["xtx"], cached["xty"]
+    except FileNotFoundError:
+        entry = harvest(reservoir_params, inputs, targets)
+        os.makedirs(STATE_CACHE_PATH, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(tmp_path, xtx=entry[0], xty=entry[1])
+        os.replace(tmp_path, path)
+
+    _accumulators[key] = entry
+    while len(_accumulators) > MEMORY_ENTRIES:
+        _accumulators.popitem(last=False)
+    return entry
+
+
+def solve_readout(xtx, xty, ridge):
+    # (Wout, bias) of the ridge readout, solving (XᵀX + ridge I) W = XᵀY. the bias is regularized too, as in reservoirpy
+    w = np.linalg.solve(xtx + ridge * np.eye(len(xtx)), xty)
+    return w[1:], w[:1]
+
+
+class RidgeSolver:
+    # the readout for any ridge value from one eigendecomposition XᵀX = V diag(s) Vᵀ, as W = V diag(1 / (s + ridge)) Vᵀ XᵀY.
+    # the same as solve_readout up to rounding, but each extra ridge value only costs a matrix product
+    def __init__(self, xtx, xty):
+        self.s, self.V = np.linalg.eigh(xtx)
+        self.projected_xty = self.V.T @ xty
+
+    def readout(self, ridge): # (Wout, bias), like solve_readout
+        w = self.V @ (self.projected_xty / (self.s + ridge)[:, None])
+        return w[1:], w[:1]
+
+    def predict(self, states, ridges):
+        # (len(ridges), len(states), outputs), what the readout for each of ridges outputs for the reservoir states
+        projected = states @ self.V[1:] + self.V[:1] # the states with the bias column, times V
+        return np.stack([projected @ (self.projected_xty / (self.s + ridge)[:, None]) for ridge in ridges])
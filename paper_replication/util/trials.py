@@ -0,0 +1,250 @@
+""" For running the reservoir instances of a tuning trial in parallel, each in its own process.
+
+The pieces the instances need are written once to memory-mapped .npy files in SHARED_PATH (SharedPieces), so the workers get
+the path and the piece boundaries instead of a pickled copy of the data each. The workers stay up between trials, so the
+imports and the in-memory state cache (see util.state_cache) are kept.
+
+load_trial_data and score_trial are what optimize_reservoir's objective does with a set of hyperparameters, in a form worker
+processes can import (see util.search). """
+
+import os
+import glob
+import random
+import atexit
+import tempfile
+from functools import partial
+from collections.abc import Mapping
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+from util.load_data import RepeatedPieces, prepare_arrays, repeat_rows
+from util.evaluation import ridge_sweep
+from util.state_cache import RIDGES, RidgeSolver, dataset_fingerprint, readout_accumulators, run_states
+
+TRIAL_COLUMNS = (["Note", "Exact_L", "Len/BPM"], ["Len_M", "Melodic_Charge", "Micro"], ["Micro"]) # with history, without, goal
+TRIAL_REPEATS = 5 # sample_repeats of the trial data
+FAILED_TRIAL = (10000., 0.) # the loss and r2 an instance that fails counts as
+INSTANCE_ERRORS = (ValueError, np.linalg.LinAlgError, BrokenProcessPool) # what makes an instance count as FAILED_TRIAL
+
+SHARED_PATH = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+SHARED_NAME = "trial-pieces" # the shared files are SHARED_PATH/{SHARED_NAME}-{pid of the process that wrote them}-...
+
+_shared = {} # (prefix, fingerprint) -> SharedPieces, written by this process
+_pool = None # (workers, ProcessPoolExecutor)
+
+
+class SharedPieces(Mapping):
+    # {piece: array} stored back to back in one memory-mapped .npy, piece i being rows offsets[i] to offsets[i + 1]. pickles as just
+    # the path and the boundaries, and each process maps the file when it first looks a piece up. with repeats, the rows are
+    # stored once and repeated as a piece is looked up, like RepeatedPieces
+    def __init__(self, path, pieces, offsets, repeats=1):
+        self.path = path
+        self.pieces = pieces
+        self.offsets = offsets
+        self.repeats = repeats
+        self.piece_index = {name: i for i, name in enumerate(pieces)}
+        self._array = None
+
+    @classmethod
+    def create(cls, pieces, path, repeats=1): # writes {piece: array} to path
+        arrays = [np.asarray(a).reshape(len(a), -1) for a in pieces.values()]
+        offsets = np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(int).tolist()
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, np.concatenate(arrays))
+        os.replace(tmp_path, path)
+        return cls(path, list(pieces), offsets, repeats)
+
+    def __getstate__(self):
+        return {"path": self.path, "pieces": self.pieces, "offsets": self.offsets, "repeats": self.repeats}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"], state["pieces"], state["offsets"], state["repeats"])
+
+    def __getitem__(self, name):
+        if self._array is None:
+            self._array = np.load(self.path, mmap_mode="r")
+        i = self.piece_index[name]
+        return repeat_rows(self._array[self.offsets[i]:self.offsets[i + 1]], self.repeats)
+
+    def __iter__(self):
+        return iter(self.pieces)
+
+    def __len__(self):
+        return len(self.pieces)
+
+
+def share_pieces(pieces, prefix, fingerprint):
+    # SharedPieces for {piece: array}, only written the first time this process shares them. fingerprint identifies the data, see
+    # util.state_cache.dataset_fingerprint. RepeatedPieces are written without the repeats
+    key = prefix, fingerprint
+    if key not in _shared:
+        if not _shared:
+            _remove_stale_shared()
+        path = os.path.join(SHARED_PATH, f"{SHARED_NAME}-{os.getpid()}-{prefix}-{fingerprint[:16]}.npy")
+        if isinstance(pieces, RepeatedPieces):
+            _shared[key] = SharedPieces.create(pieces.views, path, pieces.repeats)
+        else:
+            _shared[key] = SharedPieces.create(pieces, path)
+        atexit.register(_remove, path)
+    return _shared[key]
+
+
+def _remove_stale_shared():
+    # removes the shared files of processes that are gone. they're only removed at exit, so a killed search leaves its copy of the
+    # data in SHARED_PATH, which is memory when it's /dev/shm
+    for path in glob.glob(os.path.join(SHARED_PATH, f"{SHARED_NAME}-*")):
+        try:
+            os.kill(int(os.path.basename(path)[len(SHARED_NAME) + 1:].split("-")[0]), 0)
+        except ProcessLookupError:
+            try:
+                os.remove(path)
+            except OSError: # already removed, or another user's
+                pass
+        except (ValueError, PermissionError): # not named like ours, or another user's process that's still running
+            pass
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def instance_pool(workers): # a process pool kept between trials, remade if the number of workers changes or a worker died
+    global _pool
+    if _pool is None or _pool[0] != workers:
+        if _pool is not None:
+            _pool[1].shutdown()
+        _pool = workers, ProcessPoolExecutor(max_workers=workers)
+    return _pool[1]
+
+
+def _drop_pool(pool): # once a worker dies (out of memory, crash) the pool is no use, the next submit gets a new one
+    global _pool
+    if _pool is not None and _pool[1] is pool:
+        _pool = None
+        pool.shutdown(wait=False)
+
+
+def _drop_broken_pool(pool, future):
+    if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+        _drop_pool(pool)
+
+
+def _shutdown_pool():
+    if _pool is not None:
+        _pool[1].shutdown()
+
+
+atexit.register(_shutdown_pool)
+
+
+def run_instance(reservoir_params, train_inputs, train_targets, test_inputs, test_targets, ridges, fingerprint, keep_accumulators=False):
+    # (ridge_sweep table, the best of ridges for this instance, {piece: predictions with that ridge}, (XᵀX, XᵀY) if
+    # keep_accumulators else None) for one reservoir, with the readout solved from the training pieces and scored on the test
+    # pieces. the pieces are {piece: array}, RepeatedPieces or SharedPieces, and are looked up one at a time
+    accumulators = readout_accumulators(reservoir_params, train_inputs.values(), train_targets.values(), fingerprint)
+    solver = RidgeSolver(*accumulators)
+
+    states = run_states(reservoir_params, test_inputs)
+    sweep = ridge_sweep(solver, states, test_targets, ridges)
+
+    instance_ridge = ridges[sweep["loss"].idxmin()]
+    predictions = {piece: solver.predict(piece_states, [instance_ridge])[0] for piece, piece_states in states.items()}
+    return sweep, instance_ridge, predictions, accumulators if keep_accumulators else None
+
+
+def run_instances(instance_params, train_inputs, train_targets, test_inputs, test_targets, ridges, fingerprint, workers=1):
+    # futures of run_instance for each of instance_params (create_reservoir keyword arguments), in the same order, the last one
+    # keeping its accumulators. with more than one worker they run in instance_pool, on shared copies of the pieces
+    last = len(instance_params) - 1
+    if workers == 1:
+        futures = []
+        for i, reservoir_params in enumerate(instance_params):
+            future = Future()
+            try:
+                future.set_result(run_instance(reservoir_params, train_inputs, train_targets, test_inputs, test_targets, ridges, fingerprint, i == last))
+            except Exception as e:
+                future.set_exception(e)
+            futures.append(future)
+        return futures
+
+    train_inputs = share_pieces(train_inputs, "train_inputs", fingerprint)
+    train_targets = share_pieces(train_targets, "train_targets", fingerprint)
+    test_fingerprint = dataset_fingerprint(test_inputs.values(), test_targets.values())
+    test_inputs = share_pieces(test_inputs, "test_inputs", test_fingerprint)
+    test_targets = share_pieces(test_targets, "test_targets", test_fingerprint)
+
+    futures = []
+    for i, reservoir_params in enumerate(instance_params):
+        args = run_instance, reservoir_params, train_inputs, train_targets, test_inputs, test_targets, ridges, fingerprint, i == last
+        pool = instance_pool(workers)
+        try:
+            future = pool.submit(*args)
+        except BrokenProcessPool: # a worker died since the pool was last used, and _drop_broken_pool may not have run yet
+            _drop_pool(pool)
+            pool = instance_pool(workers)
+            future = pool.submit(*args)
+        future.add_done_callback(partial(_drop_broken_pool, pool))
+        futures.append(future)
+    return futures
+
+
+class TrialData:
+    # the shuffled training pieces and the test pieces a trial's instances are fit and scored on, each as {piece: array}
+    def __init__(self, train_inputs, train_targets, test_inputs, test_targets):
+        self.train_inputs = train_inputs
+        self.train_targets = train_targets
+        self.test_inputs = test_inputs
+        self.test_targets = test_targets
+        self.fingerprint = dataset_fingerprint(train_inputs.values(), train_targets.values())
+
+
+def load_trial_data(data_path, metadata_path, columns=TRIAL_COLUMNS, sample_repeats=TRIAL_REPEATS):
+    # the same data as optimize_reservoir's objective gets for the Micro goal, with the training pieces in the same order. read
+    # with prepare_arrays, and kept as RepeatedPieces, so the repeats are only made a piece at a time as a trial looks them up
+    train, _, test = prepare_arrays(data_path, metadata_path, *columns, sample_repeats, dtype=np.float64, splits=("train", "test"))
+    return TrialData(*training_pieces(train), *test.repeated_by_piece())
+
+
+def training_pieces(train): # repeated_by_piece of the training split, in the shuffled order the objective trains on
+    train_keys = list(train.pieces)
+    random.Random(4).shuffle(train_keys)
+    return train.repeated_by_piece(train_keys)
+
+
+def trial_ridges(config, ridge=None): # the ridge values a trial scores, see optimize_reservoir's objective
+    return np.asarray([ridge] if ridge is not None else config.get("ridges", RIDGES), dtype=float)
+
+
+def summarize_sweeps(ridges, sweeps):
+    # the objective's returned dict for one trial from each instance's [loss, r2] for every ridge value (FAILED_TRIAL for a
+    # failed instance), keeping the ridge with the lowest loss over all the instances
+    ridge_losses, ridge_r2s = np.mean(sweeps, axis=0).T
+    best = int(np.argmin(ridge_losses))
+    return {'loss': float(ridge_losses[best]),
+            'r2': float(ridge_r2s[best]),
+            'ridge': float(ridges[best]),
+            'ridge_losses': dict(zip(map(str, ridges), ridge_losses.tolist()))}
+
+
+def score_trial(data, config, *, N, sr, lr, input_scaling, seed, rc_connectivity, input_connectivity, ridge=None, activation="relu"):
+    # optimize_reservoir's objective without the printing and logging, on TrialData. the instances run in this process unless
+    # config has instance_workers
+    ridges = trial_ridges(config, ridge)
+    instance_params = [dict(input_scaling=input_scaling, N=N, sr=sr, lr=lr, seed=seed + i, rc_connectivity=rc_connectivity, input_connectivity=input_connectivity, activation_func=activation)
+                       for i in range(config['instances_per_trial'])]
+    futures = run_instances(instance_params, data.train_inputs, data.train_targets, data.test_inputs, data.test_targets, ridges, data.fingerprint,
+                            workers=config.get("instance_workers", 1))
+
+    sweeps = []
+    for future in futures:
+        try:
+            sweep, _, _, _ = future.result()
+            sweeps.append(sweep[["loss", "r2"]].to_numpy())
+        except INSTANCE_ERRORS:
+            sweeps.append(np.tile(FAILED_TRIAL, (len(ridges), 1)))
+    return summarize_sweeps(ridges, sweeps)
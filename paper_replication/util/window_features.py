@@ -0,0 +1,90 @@
+""" For computing the neighbour-window note features of extract_features for a whole piece at once. """
+
+import numpy as np
+
+THRESHOLDS = [.01, .05, .1, .5, 1, 2, 4] # in the same order as dists in extract_features
+
+CIRCLE_OF_FIFTHS = np.array([0, 7, 2, 9, 4, 11, 6, 1, 8, 3, 10, 5]) # position of each pitch class on the circle of fifths
+
+
+def _first_true(guess, pred, low, high):
+    # pred(i) is monotone (all False, then all True) on [low, high]. guess comes from searchsorted, which can be off by a little
+    # from pred's own rounding, so step it until it's exactly the first True (or high if there's none)
+    guess = np.clip(guess, low, high)
+    while True:
+        back = (guess > low) & pred(np.maximum(guess - 1, 0))
+        if not back.any():
+            break
+        guess = guess - back
+    while True:
+        forward = (guess < high) & ~pred(np.minimum(guess, high - 1))
+        if not forward.any():
+            break
+        guess = guess + forward
+    return guess
+
+
+def window_features(notes, starts, lengths, window=100, thresholds=THRESHOLDS):
+    # starts must be sorted. each note looks at up to window notes before and after it, see extract_features for the columns.
+    # the within/behind/ahead counts are (len(thresholds), notes) arrays
+    notes = np.asarray(notes, dtype=float)
+    starts = np.asarray(starts, dtype=float)
+    lengths = np.asarray(lengths, dtype=float)
+    num_notes = len(starts)
+    n = np.arange(num_notes)
+    ends = starts + lengths
+
+    lo = np.maximum(n - window, 0) # first note behind in the window
+    hi = np.minimum(n + window, num_notes - 1) + 1 # one past the last note ahead in the window
+    first_equal = np.searchsorted(starts, starts, side="left")
+    after_equal = np.searchsorted(starts, starts, side="right")
+
+    exact_l = n - np.maximum(first_equal, lo)
+    exact_h = np.minimum(after_equal, hi) - n - 1
+
+    # the last note behind that starts earlier. the old loop indexed the note and length lists with the position inside the window
+    # rather than the note's own index, which is kept here so the columns stay the same
+    last = first_equal - 1
+    has_last = last >= lo
+    last_in_window = np.where(has_last, last - lo, 0)
+    time_from_last = np.where(has_last, starts - starts[np.maximum(last, 0)], 0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        length_ratio = np.where(has_last, lengths / lengths[last_in_window], 1)
+    motion = np.where(has_last, notes - notes[last_in_window], 0)
+
+    # the first note ahead that starts later
+    has_next = after_equal < hi
+    time_to_next = np.where(has_next, starts[np.minimum(after_equal, num_notes - 1)] - starts, 0)
+
+    # notes ahead that start while this one is held down
+    down_while = np.maximum(np.minimum(np.searchsorted(starts, ends, side="left"), hi) - after_equal, 0)
+
+    behind_only = np.zeros((len(thresholds), num_notes), dtype=int)
+    ahead_only = np.zeros((len(thresholds), num_notes), dtype=int)
+    for t, threshold in enumerate(thresholds):
+        # first note (up to this one) less than threshold behind, and first note (from this one) not less than threshold ahead
+        behind_start = _first_true(np.searchsorted(starts, starts - threshold, side="right"), lambda i: starts - starts[i] < threshold, 0, n)
+        ahead_end = _first_true(np.searchsorted(starts, starts + threshold, side="left"), lambda i: ~(starts[i] - starts < threshold), n, num_notes)
+
+        behind_only[t] = np.maximum(first_equal - np.maximum(behind_start, lo), 0)
+        ahead_only[t] = np.maximum(np.minimum(ahead_end, hi) - after_equal, 0)
+
+    return {
+        "down_while": down_while,
+        "exact": exact_l + exact_h,
+        "exact_l": exact_l,
+        "exact_h": exact_h,
+        "motion": motion,
+        "length_ratio": length_ratio,
+        "time_from_last": time_from_last,
+        "time_to_next": time_to_next,
+        "within": behind_only + ahead_only,
+        "behind_only": behind_only,
+        "ahead_only": ahead_only,
+    }
+
+
+def melodic_charges(notes, sharps): # distance of each note from the key on the circle of fifths, from 0 to 1
+    charge_from_key = (CIRCLE_OF_FIFTHS[np.asarray(notes, dtype=int) % 12] - sharps) % 12 # shift over by sharps
+    charge_from_key = np.where(charge_from_key > 6, 12 - charge_from_key, charge_from_key)
+    return charge_from_key / 6